@@ -0,0 +1,27 @@
+from scalaremlp.bilipschitz import audit_distortion
+from scalaremlp.nn.objax import compute_scalars_chunked
+from trainer.hamiltonian_dynamics import DoubleSpringPendulum
+import numpy as np
+import time
+
+
+def pendulum_dataset_states(n_systems=10000, chunk_len=5, **kwargs):
+    """ (n_systems * chunk_len, 4, 3) states (q1, q2, p1, p2) of the DoubleSpringPendulum trajectory chunks """
+    Zs = DoubleSpringPendulum(n_systems, chunk_len, **kwargs).Zs
+    return np.asarray(Zs).reshape(-1, 4, 3)
+
+
+def audit(n_systems=10000, k=8, seed=0, **feature_kwargs):
+    """ Distortion quantiles of compute_scalars on the pendulum trajectories """
+    x = pendulum_dataset_states(n_systems)
+    start = time.perf_counter()
+    features = compute_scalars_chunked(x, **feature_kwargs)
+    # the features use <g, x_i>: distances up to the rotations fixing g
+    stats = audit_distortion(x, features, k=k, g=feature_kwargs.get('g', np.array([0, 0, -1])), seed=seed)
+    return {'n_states': len(x), 'time': time.perf_counter() - start,
+            'coincident': len(stats['coincident'][0]),
+            **{name: stats[name].summary() for name in ('near', 'far')}}
+
+
+if __name__ == "__main__":
+    print(audit())
@@ -0,0 +1,52 @@
+from scalaremlp.nn.sqrtm import sqrt_psd, sqrt_psd_jax, SQRT_BACKENDS
+from trainer.hamiltonian_dynamics import DoubleSpringPendulum
+import jax
+import jax.numpy as jnp
+import numpy as np
+import time
+
+
+def pendulum_states(n, seed=2021):
+    """ (n,4,3) states (q1, q2, p1, p2) drawn from the DoubleSpringPendulum initial conditions """
+    np.random.seed(seed)
+    z0 = DoubleSpringPendulum.sample_initial_conditions(None, n)
+    return z0.reshape(-1, 4, 3)
+
+
+def timeit(fn, repeats):
+    fn()  # warmup / compilation
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(n=100000, repeats=5, iters=None):
+    """ Accuracy (max abs error against the numpy eigh path) and throughput
+        (states per second) of every sqrt backend on the pendulum Gram matrices
+        iters: backend -> list of n_iter values to try """
+    if iters is None:
+        iters = {'jacobi': [3, 6], 'newton_schulz': [10, 20]}
+    x = pendulum_states(n)
+    V = np.einsum('bix,bjx->bij', x, x)  # (n,4,4)
+    V_jax = jnp.asarray(V)
+    ref = sqrt_psd(V)
+    results = []
+    for backend in SQRT_BACKENDS:
+        for n_iter in iters.get(backend, [None]):
+            out = sqrt_psd(V, backend=backend, n_iter=n_iter)
+            t_np = timeit(lambda: sqrt_psd(V, backend=backend, n_iter=n_iter), repeats)
+            fn = jax.jit(lambda V: sqrt_psd_jax(V, backend=backend, n_iter=n_iter))
+            out_jax = np.asarray(fn(V_jax))
+            t_jax = timeit(lambda: fn(V_jax).block_until_ready(), repeats)
+            results.append({
+                'backend': backend, 'n_iter': n_iter,
+                'err_numpy': np.abs(out - ref).max(), 'err_jax': np.abs(out_jax - ref).max(),
+                'states/s numpy': n / t_np, 'states/s jax': n / t_jax,
+            })
+    return results
+
+
+if __name__ == "__main__":
+    for row in benchmark():
+        print(row)
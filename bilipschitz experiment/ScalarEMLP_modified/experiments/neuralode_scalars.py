@@ -1,8 +1,9 @@
-from scalaremlp.nn import EquivarianceLayer_objax,compute_scalars,radial_basis_transform
+from scalaremlp.nn import EquivarianceLayer_objax,compute_scalars,radial_basis_transform,radial_basis_quantiles
 from trainer.hamiltonian_dynamics import IntegratedODETrainer,DoubleSpringPendulum,odeScalars_trial
 from torch.utils.data import DataLoader
 from oil.utils.utils import FixedNumpySeed,FixedPytorchSeed
 from trainer.utils import LoaderTo 
+from trainer.feature_cache import FeatureCache
 from oil.datasetup.datasets import split_dataset
 from oil.tuning.args import argupdated_config
 import logging
@@ -19,7 +20,7 @@ def makeTrainerScalars(*,dataset=DoubleSpringPendulum,num_epochs=2000,ndata=5000
                 data_config={'chunk_len':5,'dt':0.2,'integration_time':30,'regen':False},
                 net_config={'n_layers':3,'n_hidden':100},log_level='warn',
                 trainer_config={'log_dir':"./neuralode_scalar_results",'log_args':{'minPeriod':.02,'timeFrac':.75},}, 
-                save=True,trial=1):
+                save=True,trial=1,feature_cache=None,rbf_calibration='global'):
 
     logging.getLogger().setLevel(levels[log_level])
     # Prep the datasets splits, model, and dataloaders
@@ -28,13 +29,27 @@ def makeTrainerScalars(*,dataset=DoubleSpringPendulum,num_epochs=2000,ndata=5000
         datasets = split_dataset(base_ds,splits=split)
     
     z0_train = base_ds.Zs[datasets['train']._ids,0,:]
-    scalars_z0 = compute_scalars(z0_train.reshape(-1,4,3))
-    trans_mu, trans_gamma = radial_basis_transform(scalars_z0, nrad = n_rad) 
+    compact = net_config.get('compact',False)
+    if feature_cache is None:
+        scalars_z0 = compute_scalars(z0_train.reshape(-1,4,3),compact=compact)
+    else:
+        if not isinstance(feature_cache,FeatureCache):
+            feature_cache = FeatureCache(feature_cache)
+        scalars_z0 = feature_cache.cached(
+            compute_scalars,'compute_scalars',(z0_train.reshape(-1,4,3),),compact=compact)
+    if rbf_calibration == 'quantile':
+        # per-feature centers at the training quantiles, much smaller n_rad suffices
+        trans_mu, trans_gamma = radial_basis_quantiles(scalars_z0, nrad = n_rad)
+    else:
+        trans_mu, trans_gamma = radial_basis_transform(scalars_z0, nrad = n_rad) 
     model = EquivarianceLayer_objax(
         n_layers=net_config['n_layers'], 
         n_hidden=net_config['n_hidden'],
         mu=trans_mu,
-        gamma=trans_gamma
+        gamma=trans_gamma,
+        compact=compact,
+        rbf_k=net_config.get('rbf_k',None),
+        rbf_tile=net_config.get('rbf_tile',None)
     )
     
     dataloaders = {k:LoaderTo(DataLoader(v,batch_size=min(bs,len(v)),shuffle=(k=='train'),
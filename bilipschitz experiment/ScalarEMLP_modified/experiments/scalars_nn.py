@@ -1,11 +1,56 @@
 import torch.nn as nn
 import torch
 from torch.utils.data import TensorDataset
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import itertools
+from functools import lru_cache
 
 
-def comp_inner_products(x, stype, simplified=True):
+class SqrtPSD(torch.autograd.Function):
+    """
+    Batched square root of symmetric positive semi-definite matrices [..., k, k],
+    eigenvalues below eps are clamped to zero. The backward pass uses the
+    Daleckii-Krein formula with divided differences 1/(s_i + s_j), which stays
+    finite for the repeated (e.g. zero) eigenvalues of rank deficient Gram
+    matrices where autograd through torch.linalg.eigh returns inf/NaN.
+    """
+
+    @staticmethod
+    def forward(ctx, V, eps=1e-5):
+        evals, evecs = torch.linalg.eigh(V)
+        s = torch.where(evals > eps, evals, torch.zeros_like(evals)).sqrt()
+        ctx.save_for_backward(s, evecs)
+        return (evecs * s.unsqueeze(-2)) @ evecs.transpose(-1, -2)
+
+    @staticmethod
+    def backward(ctx, grad):
+        s, evecs = ctx.saved_tensors
+        denom = s.unsqueeze(-1) + s.unsqueeze(-2)
+        K = torch.where(denom > 0, 1 / torch.where(denom > 0, denom, torch.ones_like(denom)),
+                        torch.zeros_like(denom))
+        grad = (grad + grad.transpose(-1, -2)) / 2
+        evecsT = evecs.transpose(-1, -2)
+        return evecs @ (K * (evecsT @ grad @ evecs)) @ evecsT, None
+
+
+def sqrt_psd(V, eps=1e-5):
+    return SqrtPSD.apply(V, eps)
+
+
+@lru_cache(maxsize=None)
+def triu_plan(n, device=None):
+    """
+    Cached gather plan of comp_inner_products: the flat indices i*n + j of the
+    n(n+1)/2 upper triangular pairs i <= j, identical for every sample, so the
+    output width is static and traceable by torch.compile/jit. Shared by
+    both stype, which only change the metric.
+    """
+    rows, cols = torch.triu_indices(n, n, device=device)
+    return rows * n + cols
+
+
+def comp_inner_products(x, stype, simplified=True, bilipschitz=False):
     """
     INPUT:
     N: number of datasets
@@ -13,19 +58,30 @@ def comp_inner_products(x, stype, simplified=True):
     dim: dimension of each particle 
     x: torch tensor of size [N, n, dim]
     stype: "Euclidean" or "Minkowski"
+    simplified: only the n(n+1)/2 upper triangular entries [N, n(n+1)/2],
+    otherwise the full [N, n, n] matrix
+    bilipschitz: entries of the square root of the Gram matrix instead of the
+    Gram matrix itself (Euclidean only, the Minkowski Gram matrix is indefinite)
    
     """
     _, n, d = x.shape
-    if stype ==  "Euclidean":
-        scalars = torch.einsum('bix,bjx->bij', x, x)
+    if stype == "Euclidean":
+        y = x
     elif stype == "Minkowski":
-        G = torch.diag(-torch.ones(d))
-        G[0,0] = 1
-        G = torch.einsum('bix,bxj->bij', x, G.unsqueeze(0))
-        scalars = torch.einsum('bij,bkj->bik', G, x)
+        if bilipschitz:
+            raise ValueError("bilipschitz features need a positive semi-definite (Euclidean) Gram matrix")
+        # metric diag(1, -1, ..., -1) as a sign flip of the second argument
+        sign = -torch.ones(d, dtype=x.dtype, device=x.device)
+        sign[0] = 1
+        y = x * sign
+    else:
+        raise ValueError(f"Unknown stype {stype}")
+    scalars = torch.bmm(x, y.transpose(1, 2))  # [N, n, n]
+    if bilipschitz:
+        scalars = sqrt_psd(scalars)
     if simplified:
-        scalars = torch.triu(scalars).view(-1, n**2)
-        scalars = scalars[:, torch.nonzero(scalars[0]).squeeze(-1)]
+        # static gather of the upper triangle, no triu copy or data dependent nonzero
+        scalars = scalars.reshape(-1, n**2)[:, triu_plan(n, x.device)]  # [N, n(n+1)/2]
     return scalars 
 
 def comp_outer_products(x):
@@ -34,50 +90,93 @@ def comp_outer_products(x):
     return scalars.view(N,-1)
 
 
-def dataset_transform(data):
+# particle pairs (i <= j) of the O3equivariant inertia features: the 5 diagonal pairs first
+PAIR_INDEX = np.array([
+    [0, 0], [1, 1], [2, 2], [3, 3], [4, 4],
+    [0, 1], [0, 2], [0, 3], [0, 4],
+    [1, 2], [1, 3], [1, 4],
+    [2, 3], [2, 4],
+    [3, 4],
+])
+
+
+def transform_inputs(X, symname, bilipschitz=False):
     """
-    data: numpy dataset of two attributes: data.X, data.Y
+    Differentiable scalar featurization of a batch of raw inputs X (torch tensor
+    [N, ...] as in data.X) for the symmetry symname. Returns (scalars, X), the
+    first two tensors of dataset_transform. For O3equivariant, X is the
+    [N, 15, 3, 3] stack of outer products r_i r_j^T of the 15 particle pairs;
+    the constant identity block is added by the equivariant layers.
+    bilipschitz: use the entries of sqrt of the Gram matrix in place of the
+    inner products (O5invariant and O3equivariant).
     """
-    X = torch.from_numpy(data.X)
-    Y = torch.from_numpy(data.Y)
-    
-    if data.symname == "O5invariant":
+    if symname == "O5invariant":
         X = X.reshape(-1,2,5)
-        scalars = comp_inner_products(X, stype="Euclidean")
+        scalars = comp_inner_products(X, stype="Euclidean", bilipschitz=bilipschitz)
         
-    elif data.symname == "O3equivariant":
+    elif symname == "O3equivariant":
         n=5 # five data points
         mi = X[:,:n]
         ri = X[:,n:].reshape(-1,n,3)
-        x_outer = torch.einsum('bik,bjl->bijkl', ri, ri) #[N, n, n, dim, dim]
-        x_inner = torch.einsum('bik,bjk->bij', ri, ri) #[N, n, n]
-        # index = np.array(list(itertools.combinations_with_replacement(np.arange(0,n), r=2)))
-        index = np.array([
-            [0, 0], [1, 1], [2, 2], [3, 3], [4, 4],
-            [0, 1], [0, 2], [0, 3], [0, 4],
-            [1, 2], [1, 3], [1, 4],
-            [2, 3], [2, 4],
-            [3, 4],
-        ])
-        N = len(X)
-        X = X.new_zeros(N, 16, 3, 3)
-        X[:,:15,:,:] = x_outer[:,index[:,0],index[:,1],:,:]
-        X[:,-1,:,:] = torch.eye(3).repeat(N,1,1)
-        
-        
-        ri = x_inner[:,index[:,0], index[:,1]] # [N, 15]
-        mi1 = mi[:,index[:,0]]
-        mi2 = mi[:,index[:,1]]
+        # only the 15 needed pairs, not the full [N, n, n, dim, dim] outer product
+        r1, r2 = ri[:, PAIR_INDEX[:,0]], ri[:, PAIR_INDEX[:,1]] # [N, 15, 3]
+        X = torch.einsum('bpk,bpl->bpkl', r1, r2) # [N, 15, 3, 3]
+        if bilipschitz:
+            x_inner = sqrt_psd(torch.einsum('bik,bjk->bij', ri, ri)) # [N, n, n]
+            ri = x_inner[:,PAIR_INDEX[:,0], PAIR_INDEX[:,1]] # [N, 15]
+        else:
+            ri = torch.sum(r1 * r2, dim=-1) # [N, 15]
+        mi1 = mi[:,PAIR_INDEX[:,0]]
+        mi2 = mi[:,PAIR_INDEX[:,1]]
         
         scalars = torch.stack((mi1,mi2,ri),dim=-1) # [N, 15, 3]
-    elif data.symname == "Lorentz":
+    elif symname == "Lorentz":
         X = X.reshape(-1,4,4)
-        scalars = comp_inner_products(X, stype="Minkowski")
+        scalars = comp_inner_products(X, stype="Minkowski", bilipschitz=bilipschitz)
     else:
         raise ValueError("Wrong symname???")
+    return scalars, X
+
+
+def dataset_transform(data, bilipschitz=False, chunk_size=None, num_threads=1, raw=False):
+    """
+    data: numpy dataset of two attributes: data.X, data.Y
+    bilipschitz: sqrt-Gram instead of Gram features, see transform_inputs
+    chunk_size: featurize chunk_size samples at a time (all at once if None),
+    on num_threads threads, writing into preallocated output tensors
+    raw: also keep the raw inputs data.X as a 4th tensor of the dataset
+    (e.g. for adversarial training, which perturbs them)
+    """
+    X_raw = X = torch.from_numpy(data.X)
+    Y = torch.from_numpy(data.Y)
+    N = len(X)
+    chunk_size = chunk_size or max(N, 1)
+
+    with torch.no_grad():
+        # the first chunk fixes the output shapes
+        scalars0, X0 = transform_inputs(X[:chunk_size], data.symname, bilipschitz)
+        if len(X0) == N:
+            scalars, X = scalars0, X0
+        else:
+            scalars = scalars0.new_empty((N,) + scalars0.shape[1:])
+            Xt = X0.new_empty((N,) + X0.shape[1:])
+            scalars[:chunk_size], Xt[:chunk_size] = scalars0, X0
+
+            def fill(start):
+                scalars[start:start + chunk_size], Xt[start:start + chunk_size] = transform_inputs(
+                    X[start:start + chunk_size], data.symname, bilipschitz)
+
+            starts = range(chunk_size, N, chunk_size)
+            if num_threads > 1:
+                with ThreadPoolExecutor(num_threads) as pool:
+                    list(pool.map(fill, starts))
+            else:
+                for start in starts:
+                    fill(start)
+            X = Xt
     dim_scalars = scalars.shape[-1]
-    
-    return {'dataset': TensorDataset(scalars, X, Y), 'dim_scalars': dim_scalars}
+    tensors = (scalars, X, Y, X_raw) if raw else (scalars, X, Y)
+    return {'dataset': TensorDataset(*tensors), 'dim_scalars': dim_scalars}
 
 class BasicMLP(nn.Module):
     def __init__(
@@ -228,7 +327,7 @@ class EquivariancePermutationLayer(nn.Module):
         outI = torch.sum(self.f_Iij(inputIij), dim=1, keepdim=True) # [_, 1, 1]
         outI += torch.sum(self.f_Iii(inputIii), dim=1, keepdim=True) # [_, 1, 1]
 
-        outI = outI * x[:,15,:,:] # [_, 3, 3]
+        outI = outI * torch.eye(3, dtype=x.dtype, device=x.device) # [_, 3, 3]
         
         ## Matrices of different particles and same particles
         inputMij = torch.cat(
@@ -283,7 +382,10 @@ class EquivarianceLayer(nn.Module):
  
         scalars, x = x
         scalars = torch.cat((scalars[:,:,-1],scalars[:,:5,0]),dim=-1) # [_, 20]
-        out = torch.sum(self.f(scalars).unsqueeze(-1).unsqueeze(-1) * x, dim=1) # [_, 3, 3]
+        coeffs = self.f(scalars) # [_, 16]
+        # blocks 0..14 are the pair outer products, block 15 the identity
+        out = torch.einsum('bi,bijk->bjk', coeffs[:,:15], x) # [_, 3, 3]
+        out = out + coeffs[:,15:].unsqueeze(-1) * torch.eye(3, dtype=x.dtype, device=x.device)
         # out = torch.einsum('bi,bijk->bjk', self.f(scalars), x) # [_, 3, 3]
         return out.view(-1,9) # [_, 9]
         
@@ -4,12 +4,44 @@ from torch.utils.data import DataLoader
 from oil.datasetup.datasets import split_dataset
 from scalaremlp.datasets import Inertia,O5Synthetic,ParticleInteraction
 import torch
+import numpy as np
+from torch.utils.data import TensorDataset
 import lightning.pytorch as pl
 
 
 from trainer.trainer_scalars_nn import train_pl_model, RandomFixedLengthSampler
 from trainer.trainer_scalars_nn import EquivarianceNet, InvarianceNet
-from scalars_nn import dataset_transform
+from trainer.feature_cache import FeatureCache
+from trainer.attacks import model_inputs
+from scalars_nn import dataset_transform, transform_inputs
+
+
+def cached_dataset_transform(data, feature_cache=None, bilipschitz=False, raw=False):
+    """
+    dataset_transform(data, bilipschitz, raw=raw), with the transformed
+    features read from (or written to) feature_cache, a FeatureCache or its
+    root directory. The entry is keyed by the content of data.X, the symmetry
+    type and the feature options.
+    """
+    if feature_cache is None:
+        return dataset_transform(data, bilipschitz=bilipschitz, raw=raw)
+    if not isinstance(feature_cache, FeatureCache):
+        feature_cache = FeatureCache(feature_cache)
+
+    def transform(X, symname, bilipschitz, layout):
+        scalars, X, _ = dataset_transform(data, bilipschitz=bilipschitz)['dataset'].tensors
+        return {'scalars': scalars.numpy(), 'X': X.numpy()}
+
+    # layout 2: O3equivariant X without the constant identity block
+    out = feature_cache.cached(transform, 'dataset_transform', (data.X,), symname=data.symname,
+                               bilipschitz=bilipschitz, layout=2)
+    dtype = torch.from_numpy(data.X[:1]).dtype
+    # zero-copy unless the cache stores a different dtype (e.g. float16)
+    scalars = torch.from_numpy(out['scalars']).to(dtype)
+    X = torch.from_numpy(out['X']).to(dtype)
+    Y = torch.from_numpy(data.Y)
+    tensors = (scalars, X, Y, torch.from_numpy(data.X)) if raw else (scalars, X, Y)
+    return {'dataset': TensorDataset(*tensors), 'dim_scalars': scalars.shape[-1]}
 
 def makeTrainerScalars(
     dataset=Inertia,
@@ -33,15 +65,26 @@ def makeTrainerScalars(
         'layer_norm_mlp':False
     },
     permutation=False,
-    progress_bar=True
+    progress_bar=True,
+    feature_cache=None,
+    bilipschitz=False,
+    adversarial=None,
+    adv_eps=0.1,
+    adv_norm='linf',
+    adv_replays=4,
+    callbacks=None
 ):
+    """ adversarial: None, 'fgsm' or 'free' adversarial training on the raw
+        inputs within the adv_eps ball of the adv_norm ('free' replaying each
+        batch adv_replays times), see train_pl_model
+        callbacks: extra lightning callbacks, e.g. [certify.LipschitzLogger()] """
      
     # Prep the datasets splits, model, and dataloaders
     with FixedNumpySeed(seed),FixedPytorchSeed(seed):
         base_dataset = dataset(ndata)
         ## transform the dataset
-        base_trans = dataset_transform(
-            base_dataset
+        base_trans = cached_dataset_transform(
+            base_dataset, feature_cache, bilipschitz, raw=adversarial is not None
         ) 
         datasets = split_dataset(base_trans['dataset'], splits=split)
      
@@ -91,11 +134,60 @@ def makeTrainerScalars(
         check_val_every_n_epoch=trainer_config['check_val_every_n_epoch'],
         path_logs=trainer_config['log_dir'],
         permutation=permutation,
-        progress_bar=progress_bar
+        progress_bar=progress_bar,
+        bilipschitz=bilipschitz,
+        adversarial=adversarial,
+        adv_eps=adv_eps,
+        adv_norm=adv_norm,
+        adv_replays=adv_replays,
+        callbacks=callbacks
     )
     return test_metrics
 
 
+def load_litmodel(path_ckpt, base_dataset, trainer_config=None, bilipschitz=None):
+    """
+    The InvarianceNet / EquivarianceNet of base_dataset restored from the
+    checkpoint path_ckpt, with hparams.bilipschitz set to the featurization it
+    was trained with. bilipschitz only needs to be given for checkpoints
+    without it, and raises a ValueError if it disagrees.
+    """
+    hparams = torch.load(path_ckpt, map_location='cpu', weights_only=False).get('hyper_parameters', {})
+    trained = hparams.get('bilipschitz')
+    if trained is None:
+        bilipschitz = bool(bilipschitz)
+    elif bilipschitz is None:
+        bilipschitz = trained
+    elif bilipschitz != trained:
+        raise ValueError(f"bilipschitz={bilipschitz}, but the checkpoint was trained with bilipschitz={trained}")
+
+    # load_from_checkpoint is a classmethod (lightning refuses instances)
+    symname = base_dataset.symname
+    if symname == "O5invariant":
+        litmodel = InvarianceNet
+    elif symname == "O3equivariant":
+        litmodel = EquivarianceNet
+    elif symname == "Lorentz":
+        litmodel = InvarianceNet
+    
+    if trainer_config is None:
+        return litmodel.load_from_checkpoint(path_ckpt, bilipschitz=bilipschitz)
+    with torch.no_grad():
+        scalars, _ = transform_inputs(torch.from_numpy(base_dataset.X[:1]), symname, bilipschitz)
+    return litmodel.load_from_checkpoint(
+        path_ckpt,
+        n_in_net=scalars.shape[-1],
+        n_out_net=1, 
+        n_hidden_mlp=trainer_config['n_hidden_mlp'], 
+        n_layers_mlp=trainer_config['n_layers_mlp'],
+        layer_norm_mlp=trainer_config['layer_norm_mlp'], 
+        learning_rate=trainer_config['lr'],
+        milestones=trainer_config['milestones'],
+        gamma=trainer_config['gamma'],
+        bilipschitz=bilipschitz
+    )
+
+
 def restoreResults(
     path_ckpt,
     dataset=Inertia,
@@ -105,15 +197,21 @@ def restoreResults(
     device='cuda',
     num_gpus=1,
     split={'train':-1,'val':1000,'test':1000},
-    permutation=True,
-    trainer_config=None
+    trainer_config=None,
+    feature_cache=None,
+    bilipschitz=None
 ):
+    """ Train and test metrics of a checkpoint, on the featurization it was
+        trained with (see load_litmodel for bilipschitz) """
     # Prep the datasets splits, model, and dataloaders
     with FixedNumpySeed(seed),FixedPytorchSeed(seed):
         base_dataset = dataset(ndata)
+        # loading only draws from the torch generator, so the split below
+        # stays the one of makeTrainerScalars
+        model_load = load_litmodel(path_ckpt, base_dataset, trainer_config, bilipschitz)
         ## transform the dataset
-        base_trans = dataset_transform(
-            base_dataset
+        base_trans = cached_dataset_transform(
+            base_dataset, feature_cache, model_load.hparams.bilipschitz
         ) 
         datasets = split_dataset(base_trans['dataset'], splits=split)
      
@@ -130,34 +228,6 @@ def restoreResults(
 
         ) for k,v in datasets.items()
     }
-    if base_dataset.symname == "O5invariant":
-        litmodel = InvarianceNet(
-            n_in_net=base_trans['dim_scalars']
-        )  
-    elif base_dataset.symname == "O3equivariant":
-        litmodel = EquivarianceNet(
-            n_in_net=base_trans['dim_scalars'],
-            permutation=permutation
-        ) 
-    elif base_dataset.symname == "Lorentz":
-        litmodel = InvarianceNet(
-            n_in_net=base_trans['dim_scalars']
-        ) 
-    
-    if trainer_config is None:
-        model_load = litmodel.load_from_checkpoint(path_ckpt)
-    else:
-        model_load = litmodel.load_from_checkpoint(
-            path_ckpt,
-            n_in_net=base_trans['dim_scalars'],
-            n_out_net=1, 
-            n_hidden_mlp=trainer_config['n_hidden_mlp'], 
-            n_layers_mlp=trainer_config['n_layers_mlp'],
-            layer_norm_mlp=trainer_config['layer_norm_mlp'], 
-            learning_rate=trainer_config['lr'],
-            milestones=trainer_config['milestones'],
-            gamma=trainer_config['gamma'] 
-        )
 
     # test it on the loaded model
     trainer = pl.Trainer()
@@ -175,3 +245,58 @@ def restoreResults(
             'test_R2':test_metrics['R2']}
 
 
+def noiseSweepResults(
+    path_ckpt,
+    noise_levels=(0., 0.01, 0.02, 0.05, 0.1, 0.2),
+    n_draws=8,
+    dataset=Inertia,
+    ndata=1000+2000,
+    seed=2021,
+    device='cpu',
+    split={'train':-1,'val':1000,'test':1000},
+    eval_split='test',
+    trainer_config=None,
+    bilipschitz=None,
+    chunk_size=2**16
+):
+    """
+    Regression metrics of a checkpoint under additive Gaussian noise of
+    standard deviation noise_levels (K,) on the raw inputs of the eval_split.
+    The model and the clean raw inputs are loaded once; the K noise levels x
+    n_draws draws are stacked into a single batch of K n_draws N inputs that
+    is featurized (transform_inputs) and predicted in one vectorized pass,
+    chunk_size rows at a time.
+    The featurization is the one the checkpoint was trained with, see
+    load_litmodel for bilipschitz.
+    Returns the noise levels with the MSE and R2 curves (K,) averaged over
+    the draws, and their standard deviations over the draws.
+    """
+    with FixedNumpySeed(seed),FixedPytorchSeed(seed):
+        base_dataset = dataset(ndata)
+        # the same split as makeTrainerScalars/restoreResults (it only depends on
+        # the number of samples), of the raw inputs, without featurizing them
+        raw = TensorDataset(torch.from_numpy(base_dataset.X), torch.from_numpy(base_dataset.Y))
+        datasets = split_dataset(raw, splits=split)
+    eval_set = datasets[eval_split]
+    X, Y = next(iter(DataLoader(eval_set, batch_size=len(eval_set))))
+
+    device = torch.device(device)
+    model = load_litmodel(path_ckpt, base_dataset, trainer_config, bilipschitz).to(device).eval()
+    bilipschitz = model.hparams.bilipschitz
+    X, Y = X.to(device), Y.to(device)
+    sigma = torch.as_tensor(noise_levels, dtype=X.dtype, device=device)
+    K, N = len(sigma), len(X)
+    generator = torch.Generator(device).manual_seed(seed)
+    noise = torch.randn((K, n_draws) + X.shape, generator=generator, device=device, dtype=X.dtype)
+    noisy = (X + sigma[:, None, None, None] * noise).reshape(-1, X.shape[-1])  # [K n_draws N, D]
+    with torch.no_grad():
+        Yhat = torch.cat([
+            model(model_inputs(noisy[start:start + chunk_size], base_dataset.symname, bilipschitz))
+            for start in range(0, len(noisy), chunk_size)
+        ]).reshape(K, n_draws, N, -1)
+    err = ((Yhat - Y) ** 2).mean(dim=(-2, -1))  # [K, n_draws]
+    ybar = Y.mean(dim=0, keepdim=True)
+    R2 = ((Yhat - ybar) ** 2).sum(dim=(-2, -1)) / ((Y - ybar) ** 2).sum()  # comp_R2 of every draw
+    return {'noise': np.asarray(noise_levels),
+            'MSE': err.mean(1).cpu().numpy(), 'MSE_std': err.std(1).cpu().numpy(),
+            'R2': R2.mean(1).cpu().numpy(), 'R2_std': R2.std(1).cpu().numpy()}
@@ -0,0 +1,117 @@
+import torch
+import numpy as np
+from experiments.scalars_nn import transform_inputs
+
+
+def model_inputs(X, symname, bilipschitz=False):
+    """ Differentiable model input of the raw inputs X: the scalars for the
+        invariant nets, (scalars, X) for EquivarianceNet (O3equivariant) """
+    scalars, X = transform_inputs(X, symname, bilipschitz)
+    return (scalars, X) if symname == "O3equivariant" else scalars
+
+
+def project(delta, eps, norm):
+    """ projection onto the eps ball of the norm ('linf' or 'l2') of each row """
+    if norm == 'linf':
+        return delta.clamp(-eps, eps)
+    scale = eps / delta.norm(dim=-1, keepdim=True).clamp_min(eps)
+    return delta * scale
+
+
+def ascent_step(grad, size, norm):
+    """ step of the given size along the gradient, its sign for linf """
+    if norm == 'linf':
+        return size * grad.sign()
+    return size * grad / grad.norm(dim=-1, keepdim=True).clamp_min(1e-12)
+
+
+def uniform_ball(shape, eps, norm, generator=None, device=None, dtype=None):
+    """ uniform samples of the eps ball """
+    if norm == 'linf':
+        return (2 * torch.rand(shape, generator=generator, device=device, dtype=dtype) - 1) * eps
+    u = torch.randn(shape, generator=generator, device=device, dtype=dtype)
+    u = u / u.norm(dim=-1, keepdim=True)
+    r = torch.rand(shape[:-1] + (1,), generator=generator, device=device, dtype=dtype) ** (1 / shape[-1])
+    return eps * r * u
+
+
+def pgd_attack(model, X, Y, symname, bilipschitz=False, eps=0.1, norm='linf', n_steps=10, step_size=None,
+               restarts=1, random_init=True, target_loss=None, seed=None):
+    """
+    Batched PGD on the raw inputs X [N, D] (as in data.X) of a scalar
+    regressor, maximizing the per-sample MSE of model(model_inputs(X + delta))
+    against Y [N, n_out] over ||delta|| <= eps (norm 'linf' or 'l2').
+    The restarts are an extra batch dimension: all R x N perturbations take
+    their steps together. A sample stops (all its restarts are frozen and no
+    longer evaluated) once its loss reaches target_loss.
+    n_steps=1, random_init=False, step_size=eps gives FGSM (see fgsm_attack).
+    Returns a dict of the per-sample worst case 'mse' [N], the 'clean_mse'
+    [N], the worst perturbation 'delta' [N, D] and the number of 'steps' run.
+    """
+    was_training = model.training
+    model.eval()
+    N, D = X.shape
+    step_size = 2.5 * eps / n_steps if step_size is None else step_size
+    generator = None if seed is None else torch.Generator(X.device).manual_seed(seed)
+    loss_fn = lambda X, Y: ((model(model_inputs(X, symname, bilipschitz)) - Y) ** 2).mean(-1)
+
+    with torch.no_grad():
+        clean = loss_fn(X, Y)
+    Xr, Yr = X.repeat(restarts, 1), Y.repeat(restarts, 1)  # [R N, D], restart major
+    if random_init:
+        delta = uniform_ball((restarts * N, D), eps, norm, generator, X.device, X.dtype)
+    else:
+        delta = torch.zeros_like(Xr)
+    worst, worst_delta = clean.clone(), torch.zeros_like(X)
+    active = torch.ones(N, dtype=torch.bool, device=X.device) if target_loss is None else clean < target_loss
+    steps = 0
+    for steps in range(1, n_steps + 1):
+        rows = active.repeat(restarts).nonzero()[:, 0]
+        if not len(rows):
+            break
+        d = delta[rows].requires_grad_(True)
+        loss = loss_fn(Xr[rows] + d, Yr[rows])
+        grad, = torch.autograd.grad(loss.sum(), d)
+        with torch.no_grad():
+            delta[rows] = project(d + ascent_step(grad, step_size, norm), eps, norm)
+            loss = loss_fn(Xr[rows] + delta[rows], Yr[rows])
+            # best restart of every sample so far
+            sample = rows % N
+            best = torch.full((N,), -np.inf, dtype=loss.dtype, device=X.device).scatter_reduce(
+                0, sample, loss, 'amax')
+            better = best > worst
+            arg = torch.zeros(N, dtype=torch.long, device=X.device)
+            arg.scatter_(0, sample[loss == best[sample]], rows[loss == best[sample]])
+            worst = torch.where(better, best, worst)
+            worst_delta[better] = delta[arg[better]]
+            if target_loss is not None:
+                active &= worst < target_loss
+    model.train(was_training)
+    return {'mse': worst, 'clean_mse': clean, 'delta': worst_delta, 'steps': steps}
+
+
+def fgsm_attack(model, X, Y, symname, bilipschitz=False, eps=0.1, norm='linf'):
+    """ single step attack of size eps along the gradient (sign for linf) """
+    return pgd_attack(model, X, Y, symname, bilipschitz, eps, norm, n_steps=1, step_size=eps, random_init=False)
+
+
+def attack_dataset(model, data, bilipschitz=False, batch_size=4096, device=None, **kwargs):
+    """
+    pgd_attack over a whole numpy dataset (data.X, data.Y, data.symname as
+    for dataset_transform) in batches of batch_size samples (times the
+    restarts), e.g. the test split. kwargs are passed to pgd_attack.
+    Returns the per-sample 'mse', 'clean_mse' and 'delta' of the whole split
+    as numpy arrays, with the mean worst case 'MSE' and clean 'clean_MSE'.
+    """
+    device = device or next(model.parameters()).device
+    dtype = next(model.parameters()).dtype
+    out = {'mse': [], 'clean_mse': [], 'delta': []}
+    for start in range(0, len(data.X), batch_size):
+        X = torch.as_tensor(data.X[start:start + batch_size], device=device, dtype=dtype)
+        Y = torch.as_tensor(data.Y[start:start + batch_size], device=device, dtype=dtype)
+        res = pgd_attack(model, X, Y, data.symname, bilipschitz, **kwargs)
+        for k in out:
+            out[k].append(res[k].detach().cpu().numpy())
+    out = {k: np.concatenate(v) for k, v in out.items()}
+    out['MSE'], out['clean_MSE'] = out['mse'].mean(), out['clean_mse'].mean()
+    return out
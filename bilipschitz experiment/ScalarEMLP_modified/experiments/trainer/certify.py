@@ -0,0 +1,83 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import lightning.pytorch as pl
+
+
+def linear_weights(model):
+    """
+    The (n_out, n_in) weight matrices of the linear layers of a BasicMLP
+    (torch, or a LightningModule wrapping one as .model, e.g. InvarianceNet)
+    or a BasicMLP_objax, in order. The ReLUs in between are 1-Lipschitz.
+    """
+    mlp = getattr(model, 'model', model).mlp
+    weights = []
+    for layer in mlp:
+        if isinstance(layer, nn.Linear):
+            weights.append(layer.weight.detach())
+        elif isinstance(layer, nn.LayerNorm):
+            raise ValueError("LayerNorm has no global Lipschitz bound, train with layer_norm_mlp=False to certify")
+        elif hasattr(layer, 'w'):  # objax.nn.Linear, w of shape (n_in, n_out)
+            weights.append(torch.from_numpy(np.asarray(layer.w.value, dtype=np.float64)).T)
+    return weights
+
+
+class LipschitzCertifier(object):
+    """
+    Certified robustness radii of a BasicMLP / BasicMLP_objax regressor, from
+    an upper bound of its Lipschitz constant: the product of the spectral norms
+    of its linear layers, each inflated by the rounding error of the float64 SVD.
+    feature_lipschitz: a proven global Lipschitz constant of the featurization
+    for radii in the raw input space; the default 1 gives radii in feature space.
+    """
+
+    def __init__(self, model, feature_lipschitz=1.):
+        self.model = model
+        self.feature_lipschitz = feature_lipschitz
+
+    def layer_norms(self):
+        """ upper bounds of the spectral norms of the linear layers """
+        norms = []
+        for W in linear_weights(self.model):
+            W = W.to(torch.float64)
+            sigma = torch.linalg.matrix_norm(W, ord=2).item()
+            # the computed singular values are exact for W + E, ||E|| <= p(n) eps ||W||
+            norms.append(sigma * (1 + 4 * max(W.shape) * torch.finfo(torch.float64).eps))
+        return np.array(norms)
+
+    def lipschitz(self):
+        """ Lipschitz bound of the network (product of the layer norms) """
+        return float(np.prod(self.layer_norms()))
+
+    def predict(self, scalars):
+        """ predictions of the network on the scalars, in a single batched pass """
+        net = getattr(self.model, 'model', self.model)
+        if isinstance(net, nn.Module):
+            param = next(net.parameters())
+            with torch.no_grad():
+                return net(torch.as_tensor(scalars, dtype=param.dtype, device=param.device)).cpu().numpy()
+        return np.asarray(net(np.asarray(scalars), training=False))
+
+    def radius(self, scalars, Y, tolerance):
+        """
+        Per-sample certified radius for the inputs with features scalars [N, n_in]
+        and targets Y [N, n_out]: every perturbation of the features (of the raw
+        input, given a proven feature_lipschitz) of norm below the radius keeps
+        the prediction error ||f - Y||_2 within tolerance,
+        radius = max(0, tolerance - ||f(x) - Y||) / (L_net feature_lipschitz).
+        """
+        err = np.linalg.norm(self.predict(scalars) - np.asarray(Y).reshape(len(Y), -1), axis=-1)
+        return np.maximum(tolerance - err, 0.) / (self.lipschitz() * self.feature_lipschitz)
+
+
+class LipschitzLogger(pl.Callback):
+    """ logs the Lipschitz bound of the network of an InvarianceNet (as computed by
+        certifier, by default a LipschitzCertifier of the trained module) at the
+        end of every training epoch """
+
+    def __init__(self, certifier=None):
+        self.certifier = certifier
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        certifier = self.certifier or LipschitzCertifier(pl_module)
+        pl_module.log('lipschitz', certifier.lipschitz())
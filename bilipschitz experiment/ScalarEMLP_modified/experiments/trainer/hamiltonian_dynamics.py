@@ -238,7 +238,9 @@ class IntegratedODETrainer(Regressor):
   
 def rel_err(a,b):
     """ Relative error |a-b|/|a+b|"""
-    return jnp.sqrt(((a-b)**2).mean())/(jnp.sqrt((a**2).mean())+jnp.sqrt((b**2).mean()))#
+    sq = ((a-b)**2).mean()
+    num = jnp.where(sq>0,jnp.sqrt(jnp.where(sq>0,sq,1.)),0.) # finite gradient where a == b (e.g. at t=0)
+    return num/(jnp.sqrt((a**2).mean())+jnp.sqrt((b**2).mean()))#
 
 def log_rollout_error(ds,model,minibatch):
     """ Computes the log of the geometric mean of the rollout
@@ -277,12 +279,64 @@ def log_rollout_error_ode(ds,model,minibatch):
     clamped_errs = jax.lax.clamp(1e-7,errs,np.inf)
     log_geo_mean = jnp.log(clamped_errs).mean()
     return log_geo_mean
- 
+
+def rollout_attack(ds,model,T=None,ode=False,n_steps=10,step_size=.25,tol=1e-4):
+    """ Compiled worst-case initial condition attack on the rollouts of an HNN (ode=False,
+        e.g. InvarianceLayer_objax) or NeuralODE (ode=True, e.g. EquivarianceLayer_objax) model.
+        Returns attack(z0,epsilons,key) that, for every budget eps of epsilons (n_eps,) and every
+        initial condition of z0 (bs,state_dim), runs n_steps of L2 PGD (steps of step_size*eps
+        from a random start in the ball) maximizing the log geometric mean over T (default
+        ds.T_long) of the rel_err between the model and the ds.H rollouts from z0+delta.
+        The gradients go through the adjoint of odeint; the eps grid and the batch are vmapped,
+        so a whole robustness curve is a single compiled (objax.Jit) program.
+        attack returns the per-sample worst log errors (n_eps,bs) and perturbations (n_eps,bs,state_dim). """
+    T = ds.T_long if T is None else T
+    flow = BOdeFlow if ode else BHamiltonianFlow
+    def log_errs(z0):
+        pred_zs = flow(model,z0,T,tol=tol)
+        gt_zs = BHamiltonianFlow(ds.H,z0,T,tol=tol)
+        errs = vmap(vmap(rel_err))(pred_zs,gt_zs) # (bs,T,)
+        return jnp.log(jax.lax.clamp(1e-7,errs,np.inf)).mean(-1) # (bs,)
+    objective = jax.value_and_grad(lambda z0: (lambda e: (e.sum(),e))(log_errs(z0)),has_aux=True)
+    def project(delta,eps):
+        norm = jnp.sqrt((delta**2).sum(-1,keepdims=True))
+        return delta*jnp.where(norm>eps,eps/jnp.where(norm>0,norm,1.),1.)
+    def attack_eps(z0,eps,key):
+        k1,k2 = random.split(key)
+        u = random.normal(k1,z0.shape)
+        r = random.uniform(k2,z0.shape[:1]+(1,))**(1/z0.shape[-1])
+        delta = project(eps*r*u/jnp.sqrt((u**2).sum(-1,keepdims=True)),eps)
+        def step(i,carry):
+            delta,best,best_delta = carry
+            (_,errs),g = objective(z0+delta)
+            better = errs>best
+            best,best_delta = jnp.where(better,errs,best),jnp.where(better[:,None],delta,best_delta)
+            gnorm = jnp.sqrt((g**2).sum(-1,keepdims=True))
+            delta = project(delta+step_size*eps*g/jnp.where(gnorm>0,gnorm,1.),eps)
+            return delta,best,best_delta
+        init = (delta,jnp.full(z0.shape[:1],-jnp.inf),delta)
+        delta,best,best_delta = jax.lax.fori_loop(0,n_steps,step,init)
+        errs = log_errs(z0+delta) # the last iterate
+        better = errs>best
+        return jnp.where(better,errs,best),jnp.where(better[:,None],delta,best_delta)
+    return objax.Jit(vmap(attack_eps,(None,0,None)),model.vars())
+
+def rollout_robustness_curve(ds,model,z0,epsilons,seed=0,**kwargs):
+    """ Worst-case rollout error of the model over the initial conditions z0 (bs,state_dim),
+        e.g. the test split ds.Zs[:,0], for each budget of epsilons, see rollout_attack.
+        Returns the epsilons, the geometric mean over z0 of the worst rollout errors per
+        budget ('rollout_err', as in test_Rollout), the per-sample 'log_errs' and 'delta'. """
+    attack = rollout_attack(ds,model,**kwargs)
+    log_errs,delta = attack(jnp.asarray(z0),jnp.asarray(epsilons,dtype=jnp.float32),random.PRNGKey(seed))
+    log_errs = np.asarray(log_errs)
+    return {'eps':np.asarray(epsilons),'rollout_err':np.exp(log_errs.mean(-1)),
+            'log_errs':log_errs,'delta':np.asarray(delta)}
+
+
 
 
 
 
- 
 
 
 
@@ -7,6 +7,7 @@ from torch.utils.data import DataLoader
 import torch.utils.data as data
 from experiments.scalars_nn import BasicMLP, EquivariancePermutationLayer, EquivarianceLayer
 from lightning.pytorch.callbacks import ModelCheckpoint
+from .attacks import model_inputs, project, ascent_step, uniform_ball
 
 
 #################################################################################
@@ -40,7 +41,62 @@ def comp_R2(y, yhat):
     return torch.sum(nom * nom) / torch.sum(den * den)
 
 
-class InvarianceNet(pl.LightningModule):
+class AdversarialTraining(object):
+    """
+    Adversarial training on the raw inputs for the LightningModules below,
+    chosen by their adversarial hyperparameter. The training batches then
+    carry the raw inputs as a 4th tensor (dataset_transform(..., raw=True)),
+    whose perturbation is pushed through transform_inputs (the scalar
+    featurization, with the module's symname and bilipschitz):
+    'fgsm': single step FGSM from a random start in the adv_eps ball (step
+        1.25 adv_eps), one extra forward/backward pass per training step.
+    'free': "free" adversarial training (Shafahi et al. 2019), each batch is
+        replayed adv_replays times with manual optimization, and every
+        backward pass both steps the optimizer and updates the perturbation
+        of that same batch, which is then carried over to the next batch.
+        Costs adv_replays steps per batch, train_pl_model divides the epochs
+        by adv_replays to compensate.
+    """
+
+    def adversarial_inputs(self, X, Y):
+        """ FGSM inputs of the batch """
+        if self.hparams.adversarial != 'fgsm':
+            raise ValueError(f"Unknown adversarial training mode {self.hparams.adversarial}")
+        eps, norm = self.hparams.adv_eps, self.hparams.adv_norm
+        delta = uniform_ball(X.shape, eps, norm, None, X.device, X.dtype).requires_grad_(True)
+        grad, = torch.autograd.grad(F.mse_loss(self(x=self.featurize(X + delta)), Y), delta)
+        with torch.no_grad():
+            delta = project(delta + ascent_step(grad, 1.25 * eps, norm), eps, norm)
+        return self.featurize(X + delta)
+
+    def featurize(self, X):
+        return model_inputs(X, self.hparams.symname, self.hparams.bilipschitz)
+
+    def free_training_step(self, X, Y):
+        """ adv_replays optimizer steps on the batch X, Y, returns the last loss """
+        eps, norm = self.hparams.adv_eps, self.hparams.adv_norm
+        optimizer = self.optimizers()
+        delta = getattr(self, '_free_delta', None)
+        if delta is None or delta.shape != X.shape:  # e.g. a smaller last batch
+            delta = torch.zeros_like(X)
+        for _ in range(self.hparams.adv_replays):
+            delta.requires_grad_(True)
+            loss = F.mse_loss(self(x=self.featurize(X + delta)), Y)
+            optimizer.zero_grad()
+            self.manual_backward(loss)
+            optimizer.step()
+            with torch.no_grad():
+                delta = project(delta + ascent_step(delta.grad, eps, norm), eps, norm)
+        self._free_delta = delta
+        return loss.detach()
+
+    def on_train_epoch_end(self):
+        if not self.automatic_optimization:  # manual optimization does not step the schedulers
+            self.lr_schedulers().step()
+        super().on_train_epoch_end()
+
+
+class InvarianceNet(AdversarialTraining, pl.LightningModule):
     def __init__(
             self,
             n_in_net=3,
@@ -50,9 +106,16 @@ class InvarianceNet(pl.LightningModule):
             learning_rate=1e-3,
             milestones=[30, 80, 120],
             gamma=0.5,
+            symname="O5invariant",
+            bilipschitz=False,
+            adversarial=None,
+            adv_eps=0.1,
+            adv_norm='linf',
+            adv_replays=4,
     ):
         super().__init__()
         self.save_hyperparameters()
+        self.automatic_optimization = adversarial != 'free'
         self.model = BasicMLP(
             n_in=n_in_net,
             n_out=1,
@@ -80,12 +143,16 @@ class InvarianceNet(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         # training_step defined the train loop.
-        scalars, X, Y = batch
-        # Train the model
-        Yhat = self(x=scalars)
+        scalars, X, Y, *raw = batch
+        if self.hparams.adversarial == 'free':
+            train_MSE = self.free_training_step(raw[0], Y)
+        else:
+            inputs = scalars if self.hparams.adversarial is None else self.adversarial_inputs(raw[0], Y)
+            # Train the model
+            Yhat = self(x=inputs)
 
-        # compute the train loss    
-        train_MSE = F.mse_loss(Yhat, Y)
+            # compute the train loss
+            train_MSE = F.mse_loss(Yhat, Y)
         # train_R2 = comp_R2(Y,Yhat)
 
         self.training_step_outputs.append(train_MSE)
@@ -104,6 +171,7 @@ class InvarianceNet(pl.LightningModule):
                                            self.current_epoch)
 
         self.training_step_outputs.clear()  # free memory
+        super().on_train_epoch_end()
 
     def configure_optimizers(self):
         """
@@ -122,7 +190,7 @@ class InvarianceNet(pl.LightningModule):
         """
         model.eval() and torch.no_grad() are called automatically for validation
         """
-        scalars, X, Y = batch
+        scalars, X, Y, *_ = batch
         # Train the model
         Yhat = self(x=scalars)
         # compute the loss
@@ -147,7 +215,7 @@ class InvarianceNet(pl.LightningModule):
         self.validation_step_outputs.clear()  # free memory
 
     def test_step(self, batch, batch_idx):
-        scalars, X, Y = batch
+        scalars, X, Y, *_ = batch
         # Train the model
         Yhat = self(x=scalars)
 
@@ -166,7 +234,7 @@ class InvarianceNet(pl.LightningModule):
         self.test_step_outputs.clear()  # free memory
 
 
-class EquivarianceNet(pl.LightningModule):
+class EquivarianceNet(AdversarialTraining, pl.LightningModule):
     def __init__(
             self,
             n_in_net=3,
@@ -176,10 +244,17 @@ class EquivarianceNet(pl.LightningModule):
             learning_rate=1e-3,
             milestones=[30, 80, 120],
             gamma=0.5,
-            permutation=True
+            permutation=True,
+            symname="O3equivariant",
+            bilipschitz=False,
+            adversarial=None,
+            adv_eps=0.1,
+            adv_norm='linf',
+            adv_replays=4,
     ):
         super().__init__()
         self.save_hyperparameters()
+        self.automatic_optimization = adversarial != 'free'
         if permutation == True:
             self.model = nn.Sequential(
                 EquivariancePermutationLayer(
@@ -219,12 +294,16 @@ class EquivarianceNet(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         # training_step defined the train loop.
-        scalars, X, Y = batch
-        # Train the model
-        Yhat = self(x=(scalars, X))
+        scalars, X, Y, *raw = batch
+        if self.hparams.adversarial == 'free':
+            train_MSE = self.free_training_step(raw[0], Y)
+        else:
+            inputs = (scalars, X) if self.hparams.adversarial is None else self.adversarial_inputs(raw[0], Y)
+            # Train the model
+            Yhat = self(x=inputs)
 
-        # compute the train loss
-        train_MSE = F.mse_loss(Yhat, Y)
+            # compute the train loss
+            train_MSE = F.mse_loss(Yhat, Y)
 
         self.training_step_outputs.append(train_MSE)
         # Logging to TensorBoard by default
@@ -242,6 +321,7 @@ class EquivarianceNet(pl.LightningModule):
                                            self.current_epoch)
 
         self.training_step_outputs.clear()  # free memory
+        super().on_train_epoch_end()
 
     def configure_optimizers(self):
         """
@@ -261,7 +341,7 @@ class EquivarianceNet(pl.LightningModule):
         """
         model.eval() and torch.no_grad() are called automatically for validation
         """
-        scalars, X, Y = batch
+        scalars, X, Y, *_ = batch
         # Train the model
         Yhat = self(x=(scalars, X))
         # compute the loss
@@ -287,7 +367,7 @@ class EquivarianceNet(pl.LightningModule):
         self.validation_step_outputs.clear()  # free memory
 
     def test_step(self, batch, batch_idx):
-        scalars, X, Y = batch
+        scalars, X, Y, *_ = batch
         # Train the model
         Yhat = self(x=(scalars, X))
         # compute the loss
@@ -323,8 +403,30 @@ def train_pl_model(
         check_val_every_n_epoch=1,
         path_logs="./logs/",
         permutation=False,
-        progress_bar=True
+        progress_bar=True,
+        bilipschitz=False,
+        adversarial=None,
+        adv_eps=0.1,
+        adv_norm='linf',
+        adv_replays=4,
+        callbacks=None
 ):
+    """
+    adversarial: None, 'fgsm' or 'free' adversarial training on the raw
+    inputs within the adv_eps ball of the adv_norm ('linf' or 'l2'), see
+    AdversarialTraining; the train_loader batches must then carry the raw
+    inputs (dataset_transform(..., raw=True)), featurized with bilipschitz.
+    'free' replays every batch adv_replays times, so max_epochs, min_epochs
+    and the milestones are divided by adv_replays (same number of steps).
+    callbacks: extra lightning callbacks next to the checkpointing, e.g.
+    [certify.LipschitzLogger()] to log the Lipschitz bound every epoch.
+    """
+    adversarial_kwargs = {'bilipschitz': bilipschitz, 'adversarial': adversarial, 'adv_eps': adv_eps,
+                          'adv_norm': adv_norm, 'adv_replays': adv_replays}
+    if adversarial == 'free':
+        max_epochs = -(-max_epochs // adv_replays)
+        min_epochs = -(-min_epochs // adv_replays)
+        milestones = [-(-m // adv_replays) for m in milestones]
     if progress_bar:
         progress_bar_refresh_rate = None
     else:
@@ -338,7 +440,8 @@ def train_pl_model(
             learning_rate=learning_rate,
             milestones=milestones,
             gamma=gamma,
-            permutation=permutation
+            permutation=permutation,
+            **adversarial_kwargs
         )
     elif symname == "O5invariant":
         litmodel = InvarianceNet(
@@ -348,7 +451,9 @@ def train_pl_model(
             layer_norm_mlp=layer_norm_mlp,
             learning_rate=learning_rate,
             milestones=milestones,
-            gamma=gamma
+            gamma=gamma,
+            symname=symname,
+            **adversarial_kwargs
         )
     elif symname == "Lorentz":
         litmodel = InvarianceNet(
@@ -358,7 +463,9 @@ def train_pl_model(
             layer_norm_mlp=layer_norm_mlp,
             learning_rate=learning_rate,
             milestones=milestones,
-            gamma=gamma
+            gamma=gamma,
+            symname=symname,
+            **adversarial_kwargs
         )
     else:
         raise ValueError("wrong symname???")
@@ -381,7 +488,7 @@ def train_pl_model(
         'default_root_dir': path_logs
     }
 
-    trainer = pl.Trainer(**kwargs, callbacks=[checkpoint_callback])
+    trainer = pl.Trainer(**kwargs, callbacks=[checkpoint_callback] + list(callbacks or []))
 
     trainer.fit(
         model=litmodel,
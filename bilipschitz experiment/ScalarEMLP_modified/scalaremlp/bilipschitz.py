@@ -0,0 +1,514 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from functools import partial
+import numpy as np
+import jax
+import jax.numpy as jnp
+from scalaremlp.utils import export
+from scalaremlp.nn.sqrtm import sqrt_gram, eigh_safe
+
+
+def _eigh(V, xp):
+    return np.linalg.eigh(V) if xp is np else eigh_safe(V)
+
+
+def _inv_sqrt(G, xp, eps=1e-10):
+    """ pseudo inverse square root of a batch of PSD matrices [..., r, r] """
+    evals, evecs = _eigh(G, xp)
+    keep = evals > eps * xp.maximum(evals[..., -1:], 1e-30)
+    inv = xp.where(keep, 1 / xp.sqrt(xp.where(keep, evals, 1.)), 0.)
+    return (evecs * inv[..., None, :]) @ xp.swapaxes(evecs, -1, -2)
+
+
+@export
+def theta(x):
+    """
+    x: array of shape (..., n, r)
+    output: sqrt(x x^T), array of shape (..., n, n)
+    Only for reference: the quantities below never form the n x n matrices.
+    """
+    return sqrt_gram(x, method='dual')
+
+
+@export
+def theta_dist(x, y, xp=np):
+    """
+    ||theta(x) - theta(y)||_F for batches x, y of shape (..., n, r), through r x r
+    matrices only: ||theta(x)||_F^2 = ||x||_F^2 and, with theta(x) = x Px x^T,
+    Px = (x^T x)^{-1/2}, tr(theta(x) theta(y)) = tr(Px (x^T y) Py (y^T x)).
+    xp: np, or jnp to trace/differentiate with jax
+    """
+    xt, yt = xp.swapaxes(x, -1, -2), xp.swapaxes(y, -1, -2)
+    M = xt @ y  # (..., r, r)
+    A = _inv_sqrt(xt @ x, xp) @ M  # Px x^T y
+    B = _inv_sqrt(yt @ y, xp) @ xp.swapaxes(M, -1, -2)  # Py y^T x
+    cross = xp.sum(A * xp.swapaxes(B, -1, -2), axis=(-2, -1))  # tr(A B)
+    sq = xp.sum(x * x, axis=(-2, -1)) + xp.sum(y * y, axis=(-2, -1)) - 2 * cross
+    return xp.sqrt(xp.maximum(sq, 0.))
+
+
+@export
+def procrustes_dist(x, y, xp=np):
+    """
+    D(x, y) = min_U ||x - y U||_F over orthogonal U (r, r), for batches of shape (..., n, r):
+    sqrt(||x||_F^2 + ||y||_F^2 - 2 ||x^T y||_*) with the nuclear norm as
+    tr(sqrt(M^T M)), M = x^T y
+    """
+    M = xp.swapaxes(x, -1, -2) @ y
+    evals = _eigh(xp.swapaxes(M, -1, -2) @ M, xp)[0]
+    pos = evals > 0  # sqrt with a finite derivative at the (rank deficient) zero eigenvalues
+    nuc = xp.sum(xp.where(pos, xp.sqrt(xp.where(pos, evals, 1.)), 0.), axis=-1)
+    sq = xp.sum(x * x, axis=(-2, -1)) + xp.sum(y * y, axis=(-2, -1)) - 2 * nuc
+    return xp.sqrt(xp.maximum(sq, 0.))
+
+
+@export
+def stabilizer_dist(x, y, g=None, xp=np):
+    """
+    D_g(x, y) = min_U ||x - y U||_F over the orthogonal U (r, r) fixing g, the
+    symmetry of features that also use the projections <g, x_i>, for batches
+    of shape (..., n, r): in an orthonormal basis with g / |g| first, the
+    components along g are compared as they are and the others through
+    procrustes_dist over O(r - 1). g=None gives procrustes_dist.
+    """
+    if g is None:
+        return procrustes_dist(x, y, xp)
+    g = np.asarray(g, dtype=np.float64)
+    Q = np.linalg.qr(np.concatenate([g[:, None], np.eye(len(g))], axis=1))[0][:, :len(g)]
+    x, y = x @ Q, y @ Q
+    along = xp.sum((x[..., 0] - y[..., 0]) ** 2, axis=-1)
+    return xp.sqrt(along + procrustes_dist(x[..., 1:], y[..., 1:], xp) ** 2)
+
+
+@export
+def ratio(x, y, xp=np):
+    """ ||theta(x) - theta(y)||_F / D(x, y), batched over the leading axes """
+    return theta_dist(x, y, xp) / procrustes_dist(x, y, xp)
+
+
+@export
+class RunningStats(object):
+    """
+    Streaming summary of a scalar statistic: count, min, max (with the
+    arguments attaining them) and a fixed-bin histogram over bins, from which
+    quantiles are read off to the bin resolution. Values outside the bins are
+    counted in the first/last bin. Summaries of disjoint streams merge exactly.
+    """
+
+    def __init__(self, bins=np.linspace(0, 4, 4001)):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.count = 0
+        self.min, self.max = np.inf, -np.inf
+        self.argmin = self.argmax = None
+
+    def update(self, values, args=None):
+        """ values: (B,) array; args: optional tuple of (B, ...) arrays (e.g. the
+            pairs x, y) of which the extremal entries are kept """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        finite = np.isfinite(values)
+        if not finite.all():
+            values = values[finite]
+            args = None if args is None else tuple(np.asarray(a)[finite] for a in args)
+        if not len(values):
+            return self
+        idx = np.clip(np.searchsorted(self.bins, values, side='right') - 1, 0, len(self.counts) - 1)
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+        self.count += len(values)
+        i, j = np.argmin(values), np.argmax(values)
+        if values[i] < self.min:
+            self.min = values[i]
+            self.argmin = None if args is None else tuple(np.array(a[i]) for a in args)
+        if values[j] > self.max:
+            self.max = values[j]
+            self.argmax = None if args is None else tuple(np.array(a[j]) for a in args)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError("Can only merge RunningStats with the same bins")
+        self.counts += other.counts
+        self.count += other.count
+        if other.min < self.min:
+            self.min, self.argmin = other.min, other.argmin
+        if other.max > self.max:
+            self.max, self.argmax = other.max, other.argmax
+        return self
+
+    def quantile(self, q):
+        """ quantiles q (array-like in [0, 1]) interpolated within the bins """
+        cum = np.concatenate([[0], np.cumsum(self.counts)]) / max(self.count, 1)
+        return np.interp(q, cum, self.bins)
+
+    def save(self, path):
+        """ write to path (.npz) atomically, so partially written files never appear """
+        extremal = {}
+        for name in ('argmin', 'argmax'):
+            for k, a in enumerate(getattr(self, name) or ()):
+                extremal[f'{name}_{k}'] = a
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, bins=self.bins, counts=self.counts, count=self.count, min=self.min, max=self.max,
+                 **extremal)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            stats = cls(f['bins'])
+            stats.counts, stats.count = f['counts'], int(f['count'])
+            stats.min, stats.max = float(f['min']), float(f['max'])
+            for name in ('argmin', 'argmax'):
+                args = tuple(f[k] for k in sorted((k for k in f.files if k.startswith(name + '_')),
+                                                  key=lambda k: int(k.split('_')[-1])))
+                setattr(stats, name, args or None)
+        return stats
+
+    def summary(self, q=(0.001, 0.01, 0.5, 0.99, 0.999)):
+        return {'count': self.count, 'L_min': self.min, 'L_max': self.max,
+                **{f'q{p}': v for p, v in zip(q, self.quantile(q))}}
+
+
+def gaussian_pairs(rng, batch_size, n, r):
+    """ independent standard normal pairs x, y of shape (batch_size, n, r) """
+    return rng.standard_normal((batch_size, n, r)), rng.standard_normal((batch_size, n, r))
+
+
+def nearby_pairs(rng, batch_size, n, r, scale=1e-2):
+    """ standard normal x and a small perturbation y = x + scale * noise """
+    x = rng.standard_normal((batch_size, n, r))
+    return x, x + scale * rng.standard_normal((batch_size, n, r))
+
+
+def low_rank_pairs(rng, batch_size, n, r):
+    """ standard normal pairs whose last column is nearly dependent on the others """
+    x, y = gaussian_pairs(rng, batch_size, n, r)
+    for z in (x, y):
+        z[..., -1] = (z[..., :-1] @ rng.standard_normal((batch_size, r - 1, 1)))[..., 0] \
+            + 1e-3 * z[..., -1]
+    return x, y
+
+
+SAMPLERS = {'gaussian': gaussian_pairs, 'nearby': nearby_pairs, 'low_rank': low_rank_pairs}
+
+
+@export
+def estimate_bilipschitz(n=100, r=5, n_samples=100000, batch_size=4096, sampler=gaussian_pairs, seed=None,
+                         stats=None, callback=None):
+    """
+    Monte-Carlo estimate of the bilipschitz constants L_min, L_max of theta
+    against the Procrustes distance D: draws batches of (batch_size, n, r)
+    pairs from sampler(rng, batch_size, n, r) and streams the ratios into
+    stats (a RunningStats, created if None), calling callback(stats) after
+    every batch. seed: seed or np.random.Generator.
+    """
+    rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+    stats = RunningStats() if stats is None else stats
+    for start in range(0, n_samples, batch_size):
+        x, y = sampler(rng, min(batch_size, n_samples - start), n, r)
+        stats.update(ratio(x, y), (x, y))
+        if callback is not None:
+            callback(stats)
+    return stats
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def _sphere_search(z, sign, n_steps, lr):
+    """
+    Projected gradient ascent of sign * log ratio on the unit sphere for a
+    batch of pairs z (R, 2, n, r), each of unit Frobenius norm (the ratio is
+    invariant to scaling x and y together). Steps of angle lr are taken along
+    the normalized tangent gradient with a cosine decay to lr / 100.
+    Returns the best value of every restart and the pair attaining it.
+    """
+    def objective(z):
+        vals = sign * jnp.log(ratio(z[:, 0], z[:, 1], jnp))
+        return jnp.sum(vals), vals
+
+    def step(carry, t):
+        z, best, best_z = carry
+        (_, vals), g = jax.value_and_grad(objective, has_aux=True)(z)
+        better = vals > best
+        best = jnp.where(better, vals, best)
+        best_z = jnp.where(better[:, None, None, None], z, best_z)
+        g = g - jnp.sum(g * z, axis=(1, 2, 3), keepdims=True) * z  # tangent to the sphere
+        gnorm = jnp.sqrt(jnp.sum(g * g, axis=(1, 2, 3), keepdims=True))
+        ok = jnp.isfinite(gnorm) & (gnorm > 0)
+        angle = lr * (0.01 + 0.99 * 0.5 * (1 + jnp.cos(jnp.pi * t / n_steps)))
+        g = jnp.where(ok, g / jnp.where(ok, gnorm, 1.), 0.)
+        z = jnp.cos(angle) * z + jnp.sin(angle) * g  # geodesic step
+        return (z, best, best_z), None
+
+    init = (z, jnp.full(z.shape[0], -jnp.inf, z.dtype), z)
+    (_, best, best_z), _ = jax.lax.scan(step, init, jnp.arange(n_steps))
+    return best, best_z
+
+
+@export
+def search_bilipschitz(n=100, r=5, n_restarts=64, n_steps=200, lr=0.3, sampler=gaussian_pairs, seed=None,
+                       stats=None):
+    """
+    Optimizer driven search for the pairs attaining L_min and L_max, which
+    random sampling rarely hits (nearly aligned or rank deficient pairs).
+    n_restarts starting pairs drawn from sampler are each followed by
+    n_steps of projected ascent and of projected descent of the ratio on
+    the unit sphere (jax.grad through theta_dist / procrustes_dist). The
+    best pair of every restart and direction is re-evaluated in float64 and
+    streamed into stats (a RunningStats, created if None), so its min/max
+    and argmin/argmax are the bounds found and the results can be merged
+    with those of estimate_bilipschitz. Costs 2 * n_restarts * n_steps
+    gradient evaluations. seed: seed or np.random.Generator.
+    """
+    rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+    stats = RunningStats() if stats is None else stats
+    z = np.stack(sampler(rng, n_restarts, n, r), axis=1)
+    z = jnp.asarray(z / np.sqrt(np.sum(z * z, axis=(1, 2, 3), keepdims=True)), dtype=jnp.float32)
+    for sign in (-1., 1.):
+        best_z = np.asarray(_sphere_search(z, sign, n_steps, lr)[1], dtype=np.float64)
+        x, y = best_z[:, 0], best_z[:, 1]
+        stats.update(ratio(x, y), (x, y))
+    return stats
+
+
+def _pair_ratios(f, x, i, j, g, rtol):
+    """ ||f_i - f_j|| / D_g(x_i, x_j) for the index arrays i, j, and the mask of the
+        pairs with D_g below rtol ||(x_i, x_j)||, where the ratio is undefined """
+    df = f[i] - f[j]
+    D = stabilizer_dist(x[i], x[j], g)
+    coincident = D <= rtol * np.sqrt(np.sum(x[i] ** 2 + x[j] ** 2, axis=(-2, -1)))
+    return np.sqrt(np.sum(df * df, axis=-1)) / np.where(coincident, 1., D), coincident
+
+
+@export
+def audit_distortion(x, features, k=8, n_far=None, g=np.array([0, 0, -1]), eps=1., rtol=1e-6, batch_size=65536,
+                     seed=None, bins=np.geomspace(1e-4, 1e4, 8001)):
+    """
+    Empirical distortion of a feature map over a dataset of states, without
+    the O(N^2) all-pairs loop: the ratio ||f(x_i) - f(x_j)|| / D_g(x_i, x_j)
+    against the quotient distance D_g by the rotations and reflections
+    fixing g (stabilizer_dist; g=None for features invariant to all of
+    O(r), which D_g then quotients by) is evaluated for the k nearest
+    neighbours of every state in feature space (a cKDTree on the features,
+    queried in batches) and for n_far (default k N) uniformly sampled,
+    mostly far apart pairs. eps: the neighbours are (1 + eps)
+    approximate (see cKDTree.query), several times faster than exact ones
+    in the ~12 intrinsic dimensions of the pendulum states.
+    x: (N, n, r) states, e.g. DoubleSpringPendulum.Zs reshaped to (-1, 4, 3)
+    features: callable x -> (N, m), e.g. compute_scalars (which uses g), or
+    the precomputed (N, m) array
+    Returns {'near': RunningStats, 'far': RunningStats} of the ratios, with
+    the index pairs (i, j) of the extremes as argmin/argmax, and the
+    'coincident' index pairs (i, j) whose distance D_g is zero up to rtol
+    relative to the size of the states (duplicates or symmetric copies),
+    which are left out of the stats.
+    """
+    from scipy.spatial import cKDTree
+    rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float64)
+    f = np.asarray(features(x) if callable(features) else features, dtype=np.float64)
+    N = x.shape[0]
+    n_far = k * N if n_far is None else n_far
+    near, far = RunningStats(bins), RunningStats(bins)
+    coincident = []
+
+    def update(stats, i, j):
+        ratios, skip = _pair_ratios(f, x, i, j, g, rtol)
+        stats.update(ratios[~skip], (i[~skip], j[~skip]))
+        coincident.append(np.stack([i[skip], j[skip]], axis=-1))
+
+    tree = cKDTree(f)
+    rows = max(batch_size // (k + 1), 1)
+    for start in range(0, N, rows):
+        i = np.arange(start, min(start + rows, N))
+        _, j = tree.query(f[i], k + 1, eps=eps, workers=-1)  # (rows, k+1), mostly including i itself
+        i = np.broadcast_to(i[:, None], j.shape)
+        keep = j != i
+        update(near, i[keep], j[keep])
+    for start in range(0, n_far, batch_size):
+        i, j = rng.integers(N, size=(2, min(batch_size, n_far - start)))
+        keep = i != j
+        update(far, i[keep], j[keep])
+    coincident = np.concatenate(coincident).reshape(-1, 2)
+    return {'near': near, 'far': far, 'coincident': (coincident[:, 0], coincident[:, 1])}
+
+
+def _orbit_tangents(x, g):
+    """
+    Orthonormal basis (B, n d, k) of the tangents x K^T of the orbits of the
+    rotations leaving the features invariant: those fixing g, or all of SO(d)
+    if g is None. The Jacobian of invariant features vanishes on them.
+    """
+    B, n, d = x.shape
+    if g is None:
+        Q, first = jnp.eye(d, dtype=x.dtype), 0
+    else:  # orthonormal basis with g / |g| as first column
+        Q = jnp.linalg.qr(jnp.concatenate([jnp.asarray(g, x.dtype)[:, None], jnp.eye(d, dtype=x.dtype)], axis=1))[0]
+        Q, first = Q[:, :d], 1
+    gens = [jnp.outer(Q[:, a], Q[:, b]) - jnp.outer(Q[:, b], Q[:, a])
+            for a in range(first, d) for b in range(a + 1, d)]
+    T = jnp.stack([(x @ K.T).reshape(B, n * d) for K in gens], axis=-1)
+    return jnp.linalg.qr(T)[0]
+
+
+@partial(jax.jit, static_argnums=(0, 2, 3, 4))
+def _jacobian_extremes(features, x, method, n_iter, g):
+    """ per-sample largest and smallest singular value of the Jacobian of
+        features restricted to the complement of the orbit tangents """
+    B, n, d = x.shape
+    T = _orbit_tangents(x, g)
+    project = lambda v: v - (T @ jnp.einsum('bik,bi->bk', T, v)[..., None])[..., 0]
+    if method == 'jacfwd':
+        J = jax.vmap(jax.jacfwd(lambda xi: features(xi[None])[0]))(x).reshape(B, -1, n * d)
+        s = jnp.linalg.svd(J - (J @ T) @ jnp.swapaxes(T, -1, -2), compute_uv=False)
+        return s[:, 0], s[:, n * d - T.shape[-1] - 1]
+    _, vjp = jax.vjp(features, x)
+
+    def JtJ(v):  # (B, n d) -> (B, n d), per sample J^T J v
+        jv = jax.jvp(features, (x,), (v.reshape(B, n, d),))[1]
+        return vjp(jv)[0].reshape(B, n * d)
+
+    # Lanczos with full reorthogonalization on the projected J^T J: after
+    # n d - k steps the Ritz values are its exact eigenvalues
+    m = min(n_iter, n * d - T.shape[-1])
+    v = project(jax.random.normal(jax.random.PRNGKey(0), (B, n * d), x.dtype))
+    V = jnp.zeros((B, n * d, m), x.dtype).at[..., 0].set(v / jnp.linalg.norm(v, axis=-1, keepdims=True))
+    alphas, betas = jnp.zeros((B, m), x.dtype), jnp.zeros((B, m), x.dtype)
+
+    def step(i, carry):
+        V, alphas, betas = carry
+        w = project(JtJ(V[..., i]))
+        alphas = alphas.at[:, i].set(jnp.sum(w * V[..., i], axis=-1))
+        for _ in range(2):  # against all previous vectors, twice for stability
+            w = w - (V @ jnp.einsum('bik,bi->bk', V, w)[..., None])[..., 0]
+        beta = jnp.linalg.norm(w, axis=-1)
+        betas = betas.at[:, i].set(beta)
+        nxt = jnp.where(beta[:, None] > 1e-12, w / jnp.maximum(beta, 1e-12)[:, None], 0.)
+        V = V.at[..., jnp.minimum(i + 1, m - 1)].set(jnp.where(i + 1 < m, nxt, V[..., m - 1]))
+        return V, alphas, betas
+
+    V, alphas, betas = jax.lax.fori_loop(0, m, step, (V, alphas, betas))
+    tri = jax.vmap(jnp.diag)(alphas) + jax.vmap(lambda b: jnp.diag(b, 1) + jnp.diag(b, -1))(betas[:, :-1])
+    ritz = jnp.linalg.eigvalsh(tri)
+    return jnp.sqrt(jnp.maximum(ritz[:, -1], 0.)), jnp.sqrt(jnp.maximum(ritz[:, 0], 0.))
+
+
+@export
+def jacobian_spectrum(x, features=None, g=np.array([0, 0, -1]), method='auto', n_iter=32, batch_size=4096,
+                      tol=1e-6, bins=np.geomspace(1e-6, 1e6, 12001)):
+    """
+    Local Lipschitz constants of a feature map over a dataset of states x
+    (N, n, d): the largest and smallest singular values of the per-sample
+    Jacobian (m x n d), restricted to the complement of the directions along
+    which the features are invariant (rotations fixing g, see
+    _orbit_tangents), streamed in batches of batch_size into histograms.
+    features: jax callable (B, n, d) -> (B, m) acting row by row, by default
+    compute_scalars_jax with this g (g then also defines the invariance).
+    method: 'jacfwd' (vmapped dense Jacobians and their svd), 'lanczos'
+    (n_iter batched Lanczos steps on J^T J through jvp/vjp, for larger
+    inputs) or 'auto', jacfwd for inputs of up to 64 entries.
+    Also flags the (nearly) rank deficient states, whose smallest to largest
+    nonzero Gram eigenvalue ratio is below tol: there the derivative of
+    sqrt(x x^T) blows up.
+    Returns {'sigma_max', 'sigma_min', 'gram_ratio': RunningStats with the
+    state indices of the extremes as args, 'degenerate': indices}.
+    """
+    from scalaremlp.nn.objax import compute_scalars_jax
+    x = np.asarray(x, dtype=np.float32)
+    N, n, d = x.shape
+    if features is None:
+        features = partial(compute_scalars_jax, g=jnp.asarray(g, jnp.float32))
+    if method == 'auto':
+        method = 'jacfwd' if n * d <= 64 else 'lanczos'
+    g = None if g is None else tuple(np.asarray(g, dtype=np.float64).tolist())
+    stats = {name: RunningStats(bins) for name in ('sigma_max', 'sigma_min', 'gram_ratio')}
+    degenerate = []
+    for start in range(0, N, batch_size):
+        idx = np.arange(start, min(start + batch_size, N))
+        batch = x[np.minimum(np.arange(start, start + batch_size), N - 1)]  # pad: a single compilation
+        smax, smin = (np.asarray(s)[:len(idx)] for s in _jacobian_extremes(features, jnp.asarray(batch), method,
+                                                                              n_iter, g))
+        evals = np.linalg.eigvalsh(np.swapaxes(batch[:len(idx)], -1, -2) @ batch[:len(idx)])  # nonzero evals of x x^T
+        gram_ratio = evals[:, 0] / np.maximum(evals[:, -1], 1e-30)
+        for name, values in zip(stats, (smax, smin, gram_ratio)):
+            stats[name].update(values, (idx,))
+        degenerate.append(idx[gram_ratio < tol])
+    return {**stats, 'degenerate': np.concatenate(degenerate)}
+
+
+def shard_rng(seed, point, shard):
+    """
+    Counter-based (Philox) generator of one shard: its stream only depends on
+    (seed, point, shard), never on which worker runs it or in which order
+    """
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence(seed, spawn_key=(point, shard))))
+
+
+def _shard_path(out_dir, point, shard):
+    return os.path.join(out_dir, f'point{point}_shard{shard}.npz')
+
+
+def _run_shard(out_dir, point, shard, config, n_samples, batch_size, seed):
+    stats = estimate_bilipschitz(config['n'], config['r'], n_samples, batch_size,
+                                 SAMPLERS[config.get('sampler', 'gaussian')], shard_rng(seed, point, shard))
+    path = _shard_path(out_dir, point, shard)
+    stats.save(path)
+    return point, shard
+
+
+@export
+def aggregate_sweep(out_dir):
+    """ merged RunningStats of every sweep point from the shards finished so far """
+    with open(os.path.join(out_dir, 'sweep.json')) as f:
+        meta = json.load(f)
+    results = []
+    for point, config in enumerate(meta['points']):
+        stats = RunningStats()
+        for shard in range(meta['n_shards']):
+            path = _shard_path(out_dir, point, shard)
+            if os.path.exists(path):
+                stats.merge(RunningStats.load(path))
+        results.append((config, stats))
+    return results
+
+
+@export
+def run_sweep(points, out_dir, n_samples=100000, shard_size=16384, batch_size=4096, seed=0, num_workers=None,
+              callback=None):
+    """
+    Bilipschitz estimates over a grid of points, each a dict with n, r and
+    optionally the sampler name (see SAMPLERS). The n_samples of every point
+    are split into shards of shard_size samples run on a process pool; each
+    shard draws from its own Philox stream (shard_rng) so the results do not
+    depend on num_workers, and is checkpointed to out_dir as an .npz file.
+    Rerunning with the same arguments resumes: finished shards are skipped.
+    The draws within a shard depend on batch_size, so it is part of the
+    settings checked against out_dir/sweep.json like the others.
+    callback(point, shard) is called as shards finish, e.g. to aggregate_sweep
+    incrementally. Returns aggregate_sweep(out_dir).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    n_shards = -(-n_samples // shard_size)
+    meta = {'points': list(points), 'n_samples': n_samples, 'shard_size': shard_size,
+            'batch_size': batch_size, 'seed': seed, 'n_shards': n_shards}
+    meta_path = os.path.join(out_dir, 'sweep.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) != json.loads(json.dumps(meta)):
+                raise ValueError(f"{out_dir} holds a sweep with different settings")
+    else:
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    todo = [(point, shard) for point in range(len(points)) for shard in range(n_shards)
+            if not os.path.exists(_shard_path(out_dir, point, shard))]
+    sizes = lambda shard: min(shard_size, n_samples - shard * shard_size)
+    # spawn: jax (imported here) is not fork safe
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_run_shard, out_dir, point, shard, points[point], sizes(shard), batch_size, seed)
+                   for point, shard in todo]
+        for future in as_completed(futures):
+            if callback is not None:
+                callback(*future.result())
+            else:
+                future.result()
+    return aggregate_sweep(out_dir)
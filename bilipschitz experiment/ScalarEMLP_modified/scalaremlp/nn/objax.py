@@ -1,9 +1,25 @@
+import jax
 import jax.numpy as jnp
 import objax.nn as nn
 import objax.functional as F
 import numpy as np
 from scalaremlp.utils import Named, export
 from objax.module import Module
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from .sqrtm import sqrt_gram, sqrt_gram_jax, eigh_safe, jacobi_eigh, sqrt_psd_frechet
+
+
+# upper triangle of the symmetric 4x4 sqrt(xx^T) block, kept by the compact layout
+TRIU_4 = np.triu_indices(4)
+
+
+@export
+def num_scalars(compact=False):
+    """Number of features of compute_scalars: 16 sqrt(xx^T) entries (10 when
+    compact), 4 norms, 4 projections on g, <y,y>, sqrt(<y,y>) and 4 <y,x>"""
+    return 24 if compact else 30
 
 
 def Sequential(*args):
@@ -22,6 +38,82 @@ def radial_basis_transform(x, nrad=100):
     return mu, gamma
 
 
+@export
+class QuantileSketch(object):
+    """
+    Streaming per-feature quantiles of (n, n_features) chunks in bounded
+    memory: each feature keeps at most capacity weighted points; when more
+    arrive, the merged points are compressed to capacity equal-weight points
+    at evenly spaced ranks. Exact while fewer than capacity values were seen,
+    otherwise the rank error is about n_seen/capacity; the extremes are
+    tracked exactly.
+    """
+
+    def __init__(self, n_features, capacity=4096):
+        self.capacity = capacity
+        self.values = np.zeros((n_features, 0))
+        self.weights = np.zeros((n_features, 0))
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+        self.count = 0
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1, self.values.shape[0]).T  # (n_features, n)
+        self.count += x.shape[1]
+        self.min = np.minimum(self.min, x.min(axis=1))
+        self.max = np.maximum(self.max, x.max(axis=1))
+        values = np.concatenate([self.values, x], axis=1)
+        weights = np.concatenate([self.weights, np.ones_like(x)], axis=1)
+        order = np.argsort(values, axis=1)
+        self.values = np.take_along_axis(values, order, axis=1)
+        self.weights = np.take_along_axis(weights, order, axis=1)
+        if self.values.shape[1] > self.capacity:
+            ranks = (np.arange(self.capacity) + .5) * self.count / self.capacity
+            cum = np.cumsum(self.weights, axis=1)
+            idx = np.stack([np.searchsorted(c, ranks) for c in cum])
+            self.values = np.take_along_axis(self.values, np.minimum(idx, cum.shape[1] - 1), axis=1)
+            self.weights = np.full(self.values.shape, self.count / self.capacity)
+        return self
+
+    def quantile(self, q):
+        """(len(q), n_features) quantiles, linearly interpolated between points"""
+        cum = np.cumsum(self.weights, axis=1) - self.weights / 2  # mid-rank of each point
+        ranks = np.asarray(q) * self.count
+        return np.stack([np.interp(ranks, np.r_[0, c, self.count], np.r_[lo, v, hi])
+                         for c, v, lo, hi in zip(cum, self.values, self.min, self.max)], axis=-1)
+
+
+@export
+def radial_basis_quantiles(x, nrad=100, width=1.):
+    """
+    Per-feature RBF calibration: the nrad centers of feature f are placed at
+    evenly spaced quantiles of its training values, so every center covers the
+    same share of the data whatever the feature's range, and the bandwidth is
+    gamma_f = 1/(2 (width * spacing_f)^2) with spacing_f the mean center spacing.
+    x: (n, n_features) scalars or a QuantileSketch of them
+    returns mu (n_features, nrad), gamma (n_features,)
+    """
+    sketch = x if isinstance(x, QuantileSketch) else QuantileSketch(np.shape(x)[-1]).update(x)
+    mu = sketch.quantile(np.linspace(0, 1, nrad)).T  # (n_features, nrad)
+    spacing = (mu[:, -1] - mu[:, 0]) / (nrad - 1)
+    # constant features: any narrow width, relative to the scale of the data
+    spacing = np.maximum(spacing, 1e-6 * max(1., np.abs(mu).max()))
+    gamma = 1 / (2 * (width * spacing) ** 2)
+    return mu, gamma
+
+
+@export
+def rbf_num_centers(mu, gamma, tol=1e-4):
+    """
+    Number of centers k of the uniform grid mu such that keeping only the k
+    centers nearest to a scalar drops RBF terms exp(-gamma (s - mu)^2) < tol,
+    i.e. the rbf_k to use in EquivarianceLayer_objax for that accuracy
+    """
+    spacing = mu[1] - mu[0]
+    radius = np.sqrt(np.log(1 / tol) / gamma)
+    return int(min(len(mu), 2 * np.ceil(radius / spacing) + 2))
+
+
 # def comp_inner_products(x, take_sqrt=True):
 #     """
 #     INPUT: batch (q1, q2, p1, p2) = z
@@ -39,70 +131,136 @@ def radial_basis_transform(x, nrad=100):
 #         scalars = np.concatenate([xxsqrt, scalars], axis=-1)  # (n,20)
 #         # print(scalars)
 #     return scalars
-def comp_inner_products(x, take_sqrt=True):
+def _scalars_dtype(dtype):
+    """ float dtype of the features of states of the given dtype (at least float32) """
+    return np.result_type(dtype, np.float32)
+
+
+def comp_inner_products(x, take_sqrt=True, sqrt_method='gram', sqrt_backend='eigh', compact=False, out=None):
     """
     INPUT: batch (q1, q2, p1, p2) = z
     N: number of datasets
     dim: dimension  
     x: numpy tensor of size [N, 4, dim] 
+    sqrt_method: how sqrt(xx^T) is decomposed, see sqrtm.sqrt_gram
+    sqrt_backend: 'eigh', 'jacobi' or 'newton_schulz', see sqrtm.sqrt_psd
+    compact: keep only the 10 upper triangular entries of the symmetric sqrt(xx^T)
+    out: optional preallocated [N, 20] / [N, 14] array (or column slice) the
+    sqrt block and the norms are written into
     """
 
     n = x.shape[0]
+    n_sqrt = (10 if compact else 16) if take_sqrt else 0
+    if out is None:
+        out = np.empty((n, n_sqrt + 4), dtype=_scalars_dtype(x.dtype))
+    if take_sqrt:
+        # square root of the Gram matrix xx^T, computed for the whole batch at once
+        xxsqrt = sqrt_gram(x, method=sqrt_method, eps=1e-5, backend=sqrt_backend)  # (n,4,4)
+        out[:, :n_sqrt] = xxsqrt[:, TRIU_4[0], TRIU_4[1]] if compact else xxsqrt.reshape(n, -1)  # (n,10) or (n,16)
     # original inner product
     # scalars = np.einsum('bix,bjx->bij', x, x).reshape(n, -1)  # (n,16)
-    scalars = np.sqrt(np.einsum('bix,bix->bi', x, x))  # (n,16)
-    # print(f"scalars:\n{scalars}")
-    # print(f"scalars shape:\n{scalars.shape}")
-    if take_sqrt:
-        # xxsqrt = np.sqrt(np.einsum('bix,bix->bi', x, x))  # (n,4)
-        xxsqrt = np.zeros((n, 16))
-        for i in range(n):
-            
-        # change the scalar with dim (100,4)
-            mat=x[i] # (4,3)
-            V=mat@mat.T # (4,4)
-
-            Eval, Evec=np.linalg.eigh(V)
-            U=Evec
-            Sigma=np.diag(Eval)
+    out[:, n_sqrt:] = np.sqrt(np.einsum('bix,bix->bi', x, x))  # (n,4)
+    return out  # (n,14) or (n,20)
 
-            # print(np.allclose(V, U@Sigma@U.T))  # True
 
-            Sigma=np.where(Sigma > 1e-5, Sigma, 0)  # set small eigenvalues to zero
-            sqrt_Sigma=np.sqrt(Sigma)
+@export
+def compute_scalars(x, g=np.array([0, 0, -1]), sqrt_method='gram', sqrt_backend='eigh', compact=False,
+                    plan=None, out=None):
+    """Input x of dim [n, 4, 3]
+    compact: upper triangular layout of the sqrt(xx^T) block, 24 features instead of 30
+    plan: optional FeaturePlan for other particle counts and dimensions, which
+    then defines the features (its own g, pairs and layout)
+    out: optional preallocated [n, n_scalars] array (e.g. a slice of a memmap)
+    the features are written into, column block by column block"""
+    if plan is not None:
+        if out is None:
+            return plan.numpy(x)
+        out[...] = plan.numpy(x)
+        return out
+    x = np.asarray(x)
+    if out is None:
+        out = np.empty((x.shape[0], num_scalars(compact)), dtype=_scalars_dtype(x.dtype))
+    n_xx = out.shape[1] - 10
+    comp_inner_products(x, sqrt_method=sqrt_method, sqrt_backend=sqrt_backend, compact=compact,
+                        out=out[:, :n_xx])  # (n,20) or (n,14)
+
+    out[:, n_xx:n_xx + 4] = np.inner(g, x)  # (n,4)
 
+    y = x[:, 0, :] - x[:, 1, :]  # x1-x2 (n,3)
+    yy = np.sum(y * y, axis=-1)  # <x1-x2, x1-x2> | (n,)
+    out[:, n_xx + 4] = yy
+    out[:, n_xx + 5] = np.sqrt(yy)
 
-            map_mat=U@sqrt_Sigma@U.T
+    out[:, n_xx + 6:] = np.einsum('bx,bjx->bj', y, x)  # <q1-q2, u>, u=q1-q0, q2-q0, p1, p2 | (n, 4)
+    return out  # (n,30) or (n,24)
 
-            # print(map_mat)
 
-            output_val=map_mat.flatten()  # (16,)
-            xxsqrt[i]=output_val
-        
-        # print(f"xxsqrt:\n{xxsqrt}")
-        # print(f"xxsqrt shape:\n{xxsqrt.shape}")
-        scalars = np.concatenate([xxsqrt, scalars], axis=-1)  # (n,20)
-        # print(f"scalars after sqrt:\n{scalars}")
-        # print(f"scalars after sqrt shape:\n{scalars.shape}")
-    return scalars
+def _as_chunks(x, chunk_size):
+    """(start, chunk) for an array/memmap [n, 4, 3], or for an iterable of [chunk, 4, 3] arrays"""
+    if hasattr(x, 'shape'):
+        for start in range(0, x.shape[0], chunk_size):
+            yield start, x[start:start + chunk_size]
+    else:
+        start = 0
+        for chunk in x:
+            yield start, chunk
+            start += len(chunk)
 
 
 @export
-def compute_scalars(x, g=np.array([0, 0, -1])):
-    """Input x of dim [n, 4, 3]"""
-    x = np.array(x)
-    xx = comp_inner_products(x)  # (n,20)
-
-    xg = np.inner(g, x)  # (n,4)
-
-    y = x[:, 0, :] - x[:, 1, :]  # x1-x2 (n,3)
-    yy = np.sum(y * y, axis=-1, keepdims=True)  # <x1-x2, x1-x2> | (n,)
-    yy = np.concatenate([yy, np.sqrt(yy)], axis=-1)  # (n,2)
+def iter_scalars(x, chunk_size=65536, num_threads=1, **kwargs):
+    """
+    Streaming compute_scalars: yields (start, features) for consecutive chunks
+    of x, an array or memmap [n, 4, 3] or an iterable (e.g. a generator reading
+    from disk) of [chunk, 4, 3] arrays, in order. Peak memory is bounded by the
+    chunks in flight: with num_threads > 1 up to 2*num_threads chunks are
+    computed concurrently on a thread pool (the batched linear algebra
+    releases the GIL). kwargs are passed to compute_scalars.
+    """
+    chunks = _as_chunks(x, chunk_size)
+    if num_threads <= 1:
+        for start, chunk in chunks:
+            yield start, compute_scalars(chunk, **kwargs)
+        return
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = deque()
+        for start, chunk in chunks:
+            pending.append((start, pool.submit(compute_scalars, chunk, **kwargs)))
+            if len(pending) >= 2 * num_threads:
+                start, future = pending.popleft()
+                yield start, future.result()
+        while pending:
+            start, future = pending.popleft()
+            yield start, future.result()
 
-    yx = np.einsum('bx,bjx->bj', y, x)  # <q1-q2, u>, u=q1-q0, q2-q0, p1, p2 | (n, 4)
 
-    scalars = np.concatenate([xx, xg, yy, yx], axis=-1)  # (n,30)
-    return scalars
+@export
+def compute_scalars_chunked(x, out=None, chunk_size=65536, num_threads=1, **kwargs):
+    """
+    compute_scalars over an array or memmap x [n, 4, 3] in chunks, each
+    written directly into its rows of out, a preallocated [n, n_scalars]
+    array (e.g. np.lib.format.open_memmap for outputs larger than RAM), so
+    that the intermediates (xx^T, its square root) only exist for one chunk
+    per thread.
+    With num_threads > 1 the chunks are computed on a thread pool.
+    kwargs are passed to compute_scalars.
+    """
+    n = x.shape[0]
+    if out is None:
+        plan = kwargs.get('plan')
+        n_scalars = num_scalars(kwargs.get('compact', False)) if plan is None else plan.n_scalars
+        out = np.empty((n, n_scalars), dtype=_scalars_dtype(x.dtype))
+    if out.shape[0] != n:
+        raise ValueError(f"out has {out.shape[0]} rows for {n} states")
+    starts = range(0, n, chunk_size)
+    fill = lambda start: compute_scalars(x[start:start + chunk_size], out=out[start:start + chunk_size], **kwargs)
+    if num_threads <= 1:
+        for start in starts:
+            fill(start)
+    else:
+        with ThreadPoolExecutor(num_threads) as pool:
+            list(pool.map(fill, starts))
+    return out
 
 
 # def comp_inner_products_jax(x: jnp.ndarray, take_sqrt=True):
@@ -119,56 +277,42 @@ def compute_scalars(x, g=np.array([0, 0, -1])):
 #         scalars = jnp.concatenate([xxsqrt, scalars], axis=-1)  # (n, 20)
 
 #     return scalars
-def comp_inner_products_jax(x: jnp.ndarray, take_sqrt=True):
+def comp_inner_products_jax(x: jnp.ndarray, take_sqrt=True, sqrt_method='gram', sqrt_backend='eigh',
+                            compact=False):
     """
     INPUT: batch (q1, q2, p1, p2) = z
     N: number of datasets
     dim: dimension  
-    x: numpy tensor of size [N, 4, dim] 
+    x: jax tensor of size [N, 4, dim] 
+    sqrt_method: how sqrt(xx^T) is decomposed, see sqrtm.sqrt_gram
+    sqrt_backend: 'eigh', 'jacobi' or 'newton_schulz', see sqrtm.sqrt_psd
+    compact: keep only the 10 upper triangular entries of the symmetric sqrt(xx^T)
     """
 
     n = x.shape[0]
     # original inner product
-    # scalars = np.einsum('bix,bjx->bij', x, x).reshape(n, -1)  # (n,16)
-    scalars = np.sqrt(np.einsum('bix,bix->bi', x, x))  # (n,16)
-    # print(f"scalars:\n{scalars}")
-    # print(f"scalars shape:\n{scalars.shape}")
+    # scalars = jnp.einsum('bix,bjx->bij', x, x).reshape(n, -1)  # (n,16)
+    scalars = jnp.sqrt(jnp.einsum('bix,bix->bi', x, x))  # (n,4)
     if take_sqrt:
-        # xxsqrt = np.sqrt(np.einsum('bix,bix->bi', x, x))  # (n,4)
-        xxsqrt = np.zeros((n, 16))
-        for i in range(n):
-            
-        # change the scalar with dim (100,4)
-            mat=x[i] # (4,3)
-            V=mat@mat.T # (4,4)
-
-            Eval, Evec=np.linalg.eigh(V)
-            U=Evec
-            Sigma=np.diag(Eval)
-
-            # print(np.allclose(V, U@Sigma@U.T))  # True
-
-            Sigma=np.where(Sigma > 1e-5, Sigma, 0)  # set small eigenvalues to zero
-            sqrt_Sigma=np.sqrt(Sigma)
-
-
-            map_mat=U@sqrt_Sigma@U.T
-
-            # print(map_mat)
-
-            output_val=map_mat.flatten()  # (16,)
-            xxsqrt[i]=output_val
-        
-        # print(f"xxsqrt:\n{xxsqrt}")
-        # print(f"xxsqrt shape:\n{xxsqrt.shape}")
-        scalars = np.concatenate([xxsqrt, scalars], axis=-1)  # (n,20)
-        # print(f"scalars after sqrt:\n{scalars}")
-        # print(f"scalars after sqrt shape:\n{scalars.shape}")
+        xxsqrt = sqrt_gram_jax(x, method=sqrt_method, eps=1e-5, backend=sqrt_backend)  # (n,4,4)
+        xxsqrt = xxsqrt[:, TRIU_4[0], TRIU_4[1]] if compact else xxsqrt.reshape(n, -1)  # (n,10) or (n,16)
+        scalars = jnp.concatenate([xxsqrt, scalars], axis=-1)  # (n,14) or (n,20)
     return scalars
 
-def compute_scalars_jax(x: jnp.ndarray, g: jnp.ndarray = jnp.array([0, 0, -1])):
-    """Input x of dim [n, 4, 3]"""
-    xx = comp_inner_products_jax(x)  # (n,20)
+def compute_scalars_jax(x: jnp.ndarray, g: jnp.ndarray = jnp.array([0, 0, -1]), sqrt_method='gram',
+                        sqrt_backend='eigh', fused=True, compact=False, plan=None):
+    """Input x of dim [n, 4, 3]
+    fused: with sqrt_method='gram' and an eigendecomposition backend ('eigh'
+    or 'jacobi'), use the single custom_jvp rule of compute_scalars_fused_jax
+    for derivatives instead of autodiff op by op
+    compact: upper triangular layout of the sqrt(xx^T) block, 24 features instead of 30
+    plan: optional FeaturePlan for other particle counts and dimensions, which
+    then defines the features (its own g, pairs and layout)"""
+    if plan is not None:
+        return plan(x)
+    if fused and sqrt_method == 'gram' and sqrt_backend in ('eigh', 'jacobi'):
+        return compute_scalars_fused_jax(x, jnp.asarray(g, dtype=x.dtype), sqrt_backend, compact)
+    xx = comp_inner_products_jax(x, sqrt_method=sqrt_method, sqrt_backend=sqrt_backend, compact=compact)  # (n,20) or (n,14)
 
     xg = jnp.inner(g, x)  # (n,4)
 
@@ -178,10 +322,227 @@ def compute_scalars_jax(x: jnp.ndarray, g: jnp.ndarray = jnp.array([0, 0, -1])):
 
     yx = jnp.einsum('bx,bjx->bj', y, x)  # <q1-q2, u>, u=q1-q0, q2-q0, p1, p2 | (n, 4)
 
-    scalars = jnp.concatenate([xx, xg, yy, yx], axis=-1)  # (n,30)
+    scalars = jnp.concatenate([xx, xg, yy, yx], axis=-1)  # (n,30) or (n,24)
     return scalars
 
 
+def _safe_sqrt(a):
+    """sqrt(a) together with 1/sqrt(a), the latter set to zero where a == 0"""
+    pos = a > 0
+    r = jnp.sqrt(jnp.where(pos, a, 1.))
+    return jnp.where(pos, r, 0.), jnp.where(pos, 1 / r, 0.)
+
+
+@export
+class FeaturePlan(object):
+    """
+    Precomputed layout of the scalar features of n_vectors vectors in R^dim,
+    generalizing the [n, 4, 3] pendulum features of compute_scalars:
+    [sqrt(xx^T) (n_vectors^2, or the upper triangle when compact), the norms |x_i|,
+    the projections <g, x_i> (if g is not None), and for every pair (a, b) in
+    pair_list with y = x_a - x_b: <y,y>, sqrt(<y,y>) and the projections <y, x_j>
+    on all vectors (pair_projections='all') or on x_a, x_b only ('endpoints')].
+    The index arrays and sizes are computed once here; calling the plan runs a
+    jitted batched kernel with the hand-derived derivative of plan_scalars_jax.
+    FeaturePlan() reproduces compute_scalars_jax (30 features, n_out=24).
+    """
+
+    def __init__(self, n_vectors=4, dim=3, g=(0, 0, -1), pair_list=((0, 1),), compact=False,
+                 pair_projections='all', sqrt_backend='eigh'):
+        if pair_projections not in ('all', 'endpoints'):
+            raise ValueError(f"Unknown pair_projections {pair_projections}, expected 'all' or 'endpoints'")
+        if sqrt_backend not in ('eigh', 'jacobi'):
+            raise ValueError(f"Unknown sqrt_backend {sqrt_backend}, expected 'eigh' or 'jacobi'")
+        self.n_vectors, self.dim = n_vectors, dim
+        self.g = None if g is None else np.asarray(g, dtype=np.float32)
+        pairs = np.asarray(pair_list, dtype=np.int64).reshape(-1, 2)
+        if pairs.size and (pairs.min() < 0 or pairs.max() >= n_vectors or np.any(pairs[:, 0] == pairs[:, 1])):
+            raise ValueError(f"pair_list must hold pairs of distinct indices in [0, {n_vectors})")
+        self.pair_a, self.pair_b = pairs[:, 0], pairs[:, 1]
+        self.compact = compact
+        self.pair_projections = pair_projections
+        self.sqrt_backend = sqrt_backend
+        # gather indices of the sqrt(xx^T) block
+        self.sqrt_rows, self.sqrt_cols = np.triu_indices(n_vectors) if compact else \
+            np.divmod(np.arange(n_vectors ** 2), n_vectors)
+        # sizes
+        self.n_pairs = len(pairs)
+        self.n_g = 0 if g is None else n_vectors
+        self.n_proj = n_vectors if pair_projections == 'all' else 2
+        self.n_scalars = len(self.sqrt_rows) + n_vectors + self.n_g + self.n_pairs * (2 + self.n_proj)
+        self.n_out = n_vectors ** 2 + self.n_pairs * self.n_proj + self.n_g
+        self.kernel = jax.jit(partial(plan_scalars_jax, self))
+
+    @classmethod
+    def from_neighbours(cls, x_ref, cutoff, positions=None, **kwargs):
+        """
+        Static topology helper: plan whose pair_list is the neighbour list of
+        the reference states x_ref [n_vectors, dim] or [N, n_vectors, dim], i.e.
+        the pairs among the vectors in positions (default all) that come closer
+        than cutoff in any reference state (k-d tree query).
+        The pair list is fixed here and not recomputed per state. It suits
+        systems whose neighbourhoods do not change (bonded chains, lattices);
+        for moving particles the union over the reference states fills up
+        towards all n(n-1)/2 pairs, and the pair features are quadratic again.
+        """
+        from scipy.spatial import cKDTree
+        x_ref = np.asarray(x_ref)
+        x_ref = x_ref.reshape(-1, *x_ref.shape[-2:])
+        positions = np.arange(x_ref.shape[1]) if positions is None else np.asarray(positions)
+        pairs = set()
+        for state in x_ref[:, positions]:
+            pairs |= cKDTree(state).query_pairs(cutoff)
+        pair_list = positions[np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)]
+        return cls(n_vectors=x_ref.shape[1], dim=x_ref.shape[2], pair_list=pair_list, **kwargs)
+
+    def __call__(self, x):
+        """Features [n, n_scalars] of x [n, n_vectors, dim] (jax)"""
+        return self.kernel(x, None if self.g is None else jnp.asarray(self.g, dtype=x.dtype))
+
+    def numpy(self, x):
+        """Same features with numpy, e.g. to calibrate radial_basis_transform"""
+        x = np.asarray(x).reshape(-1, self.n_vectors, self.dim)
+        xxsqrt = sqrt_gram(x, eps=1e-5, backend=self.sqrt_backend)
+        return self._features(xxsqrt, x, self.g, np)
+
+    def pair_diffs(self, x):
+        """y = x_a - x_b for all pairs, [n, n_pairs, dim]"""
+        return x[:, self.pair_a] - x[:, self.pair_b]
+
+    def _projections(self, y, x, xp):
+        """<y_p, x_j> for all vectors, or for the pair endpoints only, [n, n_pairs, n_proj]"""
+        if self.pair_projections == 'all':
+            return xp.einsum('bpx,bjx->bpj', y, x)
+        return xp.stack([xp.sum(y * x[:, self.pair_a], axis=-1), xp.sum(y * x[:, self.pair_b], axis=-1)], axis=-1)
+
+    def _features(self, xxsqrt, x, g, xp):
+        n = x.shape[0]
+        y = self.pair_diffs(x)  # (n,P,dim)
+        yy = xp.sum(y * y, axis=-1)  # (n,P)
+        feats = [xxsqrt[:, self.sqrt_rows, self.sqrt_cols], xp.sqrt(xp.sum(x * x, axis=-1))]
+        if g is not None:
+            feats.append(xp.inner(g, x))
+        feats += [yy, xp.sqrt(yy), self._projections(y, x, xp).reshape(n, -1)]
+        return xp.concatenate(feats, axis=-1)  # (n,n_scalars)
+
+    def assemble(self, out, x):
+        """
+        Equivariant output from the coefficients out [n, n_out]:
+        sum_j c_ij x_j + sum_p c_ip y_p + c_i g for every vector i, with the pair
+        terms restricted to the endpoints when pair_projections='endpoints'
+        """
+        k = self.n_vectors
+        n_x, n_y = k ** 2, self.n_pairs * self.n_proj
+        output = out[:, :n_x].reshape(-1, k, k) @ x  # (n,k,dim)
+        if self.n_pairs:
+            y = self.pair_diffs(x)  # (n,P,dim)
+            coeffs = out[:, n_x:n_x + n_y].reshape(-1, self.n_pairs, self.n_proj)
+            if self.pair_projections == 'all':
+                output = output + jnp.einsum('bpi,bpx->bix', coeffs, y)
+            else:
+                ends = np.stack([self.pair_a, self.pair_b], axis=-1)  # (P,2)
+                output = output.at[:, ends].add(coeffs[..., None] * y[:, :, None, :])
+        if self.g is not None:
+            output = output + out[:, n_x + n_y:, None] * jnp.asarray(self.g, dtype=x.dtype)
+        return output
+
+
+@partial(jax.custom_jvp, nondiff_argnums=(0,))
+def plan_scalars_jax(plan, x: jnp.ndarray, g):
+    """Features of the FeaturePlan plan for x [n, n_vectors, dim], g [dim] with
+    the dtype of x (or None if the plan has no g), with a hand-derived
+    derivative for the whole feature map."""
+    return _plan_scalars(plan, x, g)[0]
+
+
+def _plan_scalars(plan, x, g):
+    V = jnp.einsum('bix,bjx->bij', x, x)  # (n,k,k)
+    if plan.sqrt_backend == 'jacobi':
+        evals, evecs = jacobi_eigh(V, xp=jnp)
+    else:
+        evals, evecs = eigh_safe(V)
+    keep = evals > 1e-5
+    s = jnp.where(keep, jnp.sqrt(jnp.where(keep, evals, 1.)), 0.)
+    xxsqrt = (evecs * s[:, None, :]) @ jnp.swapaxes(evecs, -1, -2)  # (n,k,k)
+    r, inv_r = _safe_sqrt(jnp.einsum('bix,bix->bi', x, x))  # (n,k)
+    y = plan.pair_diffs(x)  # (n,P,dim)
+    yy = jnp.sum(y * y, axis=-1)  # (n,P)
+    ry, inv_ry = _safe_sqrt(yy)
+    feats = [xxsqrt[:, plan.sqrt_rows, plan.sqrt_cols], r]
+    if g is not None:
+        feats.append(jnp.inner(g, x))  # (n,k)
+    feats += [yy, ry, plan._projections(y, x, jnp).reshape(x.shape[0], -1)]
+    return jnp.concatenate(feats, axis=-1), (evals, evecs, inv_r, y, inv_ry)
+
+
+@plan_scalars_jax.defjvp
+def _plan_scalars_jvp(plan, primals, tangents):
+    x, g = primals
+    dx, dg = tangents
+    scalars, (evals, evecs, inv_r, y, inv_ry) = _plan_scalars(plan, x, g)
+    dV = jnp.einsum('bix,bjx->bij', dx, x)
+    dV = dV + jnp.swapaxes(dV, -1, -2)  # dx x^T + x dx^T
+    dxxsqrt = sqrt_psd_frechet(evals, evecs, dV, eps=1e-5)  # (n,k,k)
+    dr = jnp.einsum('bix,bix->bi', x, dx) * inv_r  # (n,k)
+    dfeats = [dxxsqrt[:, plan.sqrt_rows, plan.sqrt_cols], dr]
+    if g is not None:
+        dfeats.append(jnp.inner(dg, x) + jnp.inner(g, dx))  # (n,k)
+    dy = plan.pair_diffs(dx)
+    ydy = jnp.sum(y * dy, axis=-1)  # (n,P)
+    dyx = plan._projections(dy, x, jnp) + plan._projections(y, dx, jnp)
+    dfeats += [2 * ydy, ydy * inv_ry, dyx.reshape(x.shape[0], -1)]
+    return scalars, jnp.concatenate(dfeats, axis=-1)
+
+
+@lru_cache(maxsize=None)
+def _default_plan(backend, compact):
+    return FeaturePlan(sqrt_backend=backend, compact=compact)
+
+
+def compute_scalars_fused_jax(x: jnp.ndarray, g: jnp.ndarray, backend='eigh', compact=False):
+    """Same 30 features as compute_scalars_jax(x, g, sqrt_method='gram'),
+    with a hand-derived derivative for the whole feature map.
+    Input x of dim [n, 4, 3], g of dim [3] with the dtype of x,
+    backend 'eigh' or 'jacobi' for the eigendecomposition of xx^T.
+    compact selects the 24 feature upper triangular layout.
+    This is plan_scalars_jax for the default FeaturePlan."""
+    return plan_scalars_jax(_default_plan(backend, compact), x, g)
+
+
+@export
+def rbf_linear(scalars, mu, gamma, w, b, tile=20):
+    """
+    Fused exp(-gamma (s - mu)^2).reshape(n, -1) @ w + b for scalars (n, S),
+    centers mu (n_rad,) or per feature (S, n_rad), gamma scalar or (S,), and
+    the weight w (S*n_rad, n_hidden) of a Linear layer on the flattened
+    expansion. The centers are processed tile by tile in a lax.scan and each
+    tile is rematerialized (jax.checkpoint) in the backward pass, so neither
+    pass holds more than an (n, S, tile) slab of the (n, S, n_rad) expansion.
+    """
+    n_feat = scalars.shape[-1]
+    n_rad = mu.shape[-1]
+    mu = jnp.broadcast_to(mu, (n_feat, n_rad))
+    gamma = jnp.broadcast_to(jnp.reshape(gamma, (-1, 1)), (n_feat, 1))
+    w = w.reshape(n_feat, n_rad, -1)
+    pad = -n_rad % tile
+    if pad:
+        # padded centers get zero weights
+        mu = jnp.pad(mu, ((0, 0), (0, pad)), mode='edge')
+        w = jnp.pad(w, ((0, 0), (0, pad), (0, 0)))
+    n_tiles = (n_rad + pad) // tile
+    mu_tiles = jnp.swapaxes(mu.reshape(n_feat, n_tiles, tile), 0, 1)  # (n_tiles, S, tile)
+    w_tiles = jnp.swapaxes(w.reshape(n_feat, n_tiles, tile, -1), 0, 1)  # (n_tiles, S, tile, n_hidden)
+
+    @jax.checkpoint
+    def step(h, tiles):
+        mu_t, w_t = tiles
+        rbf = jnp.exp(-gamma * (scalars[..., None] - mu_t) ** 2)  # (n, S, tile)
+        return h + jnp.einsum('bst,sth->bh', rbf, w_t), None
+
+    h0 = jnp.broadcast_to(b, (scalars.shape[0],) + b.shape)
+    return jax.lax.scan(step, h0, (mu_tiles, w_tiles))[0]
+
+
 @export
 class BasicMLP_objax(Module):
     def __init__(
@@ -210,20 +571,37 @@ class InvarianceLayer_objax(Module):
             self,
             n_hidden,
             n_layers,
+            sqrt_method='gram',
+            sqrt_backend='eigh',
+            compact=False,
+            plan=None,
     ):
+        """plan: optional FeaturePlan for other particle counts and dimensions,
+        replacing the [n, 4, 3] pendulum features (and g, sqrt_method, compact)"""
         super().__init__()
         self.mlp = BasicMLP_objax(
-            n_in=30, n_out=1, n_hidden=n_hidden, n_layers=n_layers
+            n_in=num_scalars(compact) if plan is None else plan.n_scalars, n_out=1, n_hidden=n_hidden,
+            n_layers=n_layers
         )
         self.g = jnp.array([0, 0, -1])
+        self.sqrt_method = sqrt_method
+        self.sqrt_backend = sqrt_backend
+        self.compact = compact
+        self.plan = plan
+        self.shape = (4, 3) if plan is None else (plan.n_vectors, plan.dim)
 
     def H(self, x):
-        scalars = compute_scalars_jax(x, self.g)
+        if self.plan is not None:
+            scalars = self.plan(x)
+        else:
+            scalars = compute_scalars_jax(x, self.g, sqrt_method=self.sqrt_method, sqrt_backend=self.sqrt_backend,
+                                          compact=self.compact)
         out = self.mlp(scalars)
         return out.sum()
 
     def __call__(self, x: jnp.ndarray):
-        x = x.reshape(-1, 4, 3)  # (n,4,3)
+        k, dim = self.shape
+        x = x.reshape(-1, k, dim)  # (n,k,dim)
         return self.H(x)
 
 
@@ -234,22 +612,88 @@ class EquivarianceLayer_objax(Module):
             n_hidden,
             n_layers,
             mu,
-            gamma
+            gamma,
+            sqrt_method='gram',
+            sqrt_backend='eigh',
+            compact=False,
+            plan=None,
+            rbf_k=None,
+            rbf_tile=None,
     ):
+        """mu, gamma: RBF centers and bandwidth shared by all scalars
+        (radial_basis_transform), or per scalar (radial_basis_quantiles)
+        plan: optional FeaturePlan for other particle counts and dimensions,
+        replacing the [n, 4, 3] pendulum features (and g, sqrt_method, compact)
+        rbf_k: if given, expand each scalar only on its rbf_k nearest centers of
+        the uniform grid mu (see rbf_num_centers) and apply the first layer as
+        a gather-and-sum over the corresponding weight rows
+        rbf_tile: if given (and rbf_k is not), compute the dense RBF expansion
+        and the first layer together with rbf_linear, rbf_tile centers at a time"""
         super().__init__()
-        self.mu = jnp.array(mu)  # (n_rad,)
-        self.gamma = jnp.array(gamma)
-        self.n_in_mlp = len(mu) * 30
-        self.mlp = BasicMLP_objax(n_in=self.n_in_mlp, n_out=24, n_hidden=n_hidden, n_layers=n_layers)
+        mu = np.asarray(mu)
+        n_rad = mu.shape[-1]
+        if rbf_k is not None and rbf_k < n_rad and (mu.ndim > 1 or not np.allclose(np.diff(mu), mu[1] - mu[0])):
+            raise ValueError("rbf_k needs a single uniformly spaced grid of centers mu")
+        self.mu = jnp.array(mu)  # (n_rad,) or per feature (n_scalars, n_rad)
+        self.gamma = jnp.array(gamma)  # scalar or per feature (n_scalars,)
+        if self.gamma.ndim == 1:
+            self.gamma = self.gamma[:, None]  # (n_scalars, 1)
+        self.n_scalars = num_scalars(compact) if plan is None else plan.n_scalars
+        if mu.ndim > 1 and mu.shape[0] != self.n_scalars:
+            raise ValueError(f"mu has centers for {mu.shape[0]} features, the layer has {self.n_scalars}")
+        self.n_in_mlp = n_rad * self.n_scalars
+        n_out = 24 if plan is None else plan.n_out
+        self.mlp = BasicMLP_objax(n_in=self.n_in_mlp, n_out=n_out, n_hidden=n_hidden, n_layers=n_layers)
         self.g = jnp.array([0, 0, -1])
+        self.sqrt_method = sqrt_method
+        self.sqrt_backend = sqrt_backend
+        self.compact = compact
+        self.plan = plan
+        self.shape = (4, 3) if plan is None else (plan.n_vectors, plan.dim)
+        self.rbf_k = None if rbf_k is None or rbf_k >= n_rad else int(rbf_k)
+        self.rbf_tile = rbf_tile
+
+    def rbf_first_layer(self, scalars):
+        """
+        First Linear layer of the mlp applied to the RBF expansion of scalars
+        (n, n_scalars), keeping only the rbf_k centers nearest to each scalar:
+        sum_{f,j} exp(-gamma (s_f - mu_c)^2) W[f*n_rad + c] + b over c = c_fj
+        """
+        n_rad, k = len(self.mu), self.rbf_k
+        spacing = self.mu[1] - self.mu[0]
+        start = jnp.round((scalars - self.mu[0]) / spacing).astype(jnp.int32) - (k - 1) // 2
+        idx = jnp.clip(start, 0, n_rad - k)[..., None] + jnp.arange(k)  # (n, n_scalars, k)
+        rbf = jnp.exp(-self.gamma * (scalars[..., None] - self.mu[idx]) ** 2)  # (n, n_scalars, k)
+        linear = self.mlp.mlp[0]
+        rows = idx + n_rad * jnp.arange(self.n_scalars)[:, None]  # rows of the (n_scalars*n_rad, n_hidden) weight
+        # one gathered (n, n_scalars, n_hidden) slab of weight rows per window position
+        step = lambda j, h: h + jnp.einsum('bs,bsh->bh', rbf[:, :, j], linear.w.value[rows[:, :, j]])
+        h0 = jnp.broadcast_to(linear.b.value, (scalars.shape[0],) + linear.b.value.shape)
+        return jax.lax.fori_loop(0, k, step, h0)
 
     def __call__(self, x, t):
-        x = x.reshape(-1, 4, 3)  # (n,4,3)
-        scalars = compute_scalars_jax(x, self.g)  # (n,30)
-        scalars = jnp.expand_dims(scalars, axis=-1) - jnp.expand_dims(self.mu, axis=0)  # (n, 30, n_rad)
-        scalars = jnp.exp(-self.gamma * scalars ** 2)  # (n, 30, n_rad)
-        scalars = scalars.reshape(-1, self.n_in_mlp)  # (n, 30*n_rad)
-        out = jnp.expand_dims(self.mlp(scalars), axis=-1)  # (n, 24, 1)
+        k, dim = self.shape
+        x = x.reshape(-1, k, dim)  # (n,k,dim)
+        if self.plan is not None:
+            scalars = self.plan(x)  # (n,n_scalars)
+        else:
+            scalars = compute_scalars_jax(x, self.g, sqrt_method=self.sqrt_method,
+                                          sqrt_backend=self.sqrt_backend,
+                                          compact=self.compact)  # (n,n_scalars)
+        if self.rbf_k is not None:
+            out = self.mlp.mlp[1:](self.rbf_first_layer(scalars))  # (n, n_out)
+        elif self.rbf_tile is not None:
+            linear = self.mlp.mlp[0]
+            hidden = rbf_linear(scalars, self.mu, self.gamma, linear.w.value, linear.b.value, self.rbf_tile)
+            out = self.mlp.mlp[1:](hidden)  # (n, n_out)
+        else:
+            scalars = jnp.expand_dims(scalars, axis=-1) - self.mu  # (n, n_scalars, n_rad)
+            scalars = jnp.exp(-self.gamma * scalars ** 2)  # (n, n_scalars, n_rad)
+            scalars = scalars.reshape(-1, self.n_in_mlp)  # (n, n_scalars*n_rad)
+            out = self.mlp(scalars)  # (n, n_out)
+        if self.plan is not None:
+            return self.plan.assemble(out, x).reshape(-1, k * dim)
+        out = jnp.expand_dims(out, axis=-1)  # (n, 24, 1)
 
         y = x[:, 0, :] - x[:, 1, :]  # x1-x2 (n,3)
         output_x = out[:, :16].reshape(-1, 4, 4) @ x  # (n,4,3)
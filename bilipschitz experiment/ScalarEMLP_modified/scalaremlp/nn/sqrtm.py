@@ -0,0 +1,231 @@
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+SQRT_BACKENDS = ('eigh', 'jacobi', 'newton_schulz')
+
+
+def _round_robin(k):
+    """ Rounds of disjoint index pairs (p, q) that together cover every pair once (circle method) """
+    m = k + k % 2
+    players = list(range(m))
+    rounds = []
+    for _ in range(m - 1):
+        pairs = [tuple(sorted((players[i], players[m - 1 - i]))) for i in range(m // 2)]
+        rounds.append([pq for pq in pairs if pq[1] < k])
+        players = [players[0], players[-1]] + players[1:-1]
+    return rounds
+
+
+def jacobi_eigh(V, sweeps=6, xp=np):
+    """
+    Batched Jacobi eigensolver for small symmetric matrices.
+    The pairs are visited in round-robin order so that the rotations of one
+    round act on disjoint pairs and are applied together as a single k x k
+    matmul over the whole batch. The number of sweeps is fixed, so under jit
+    it compiles to batched matmuls only. Eigenvalues are returned unsorted.
+    V: tensor of size [..., k, k], xp: np or jnp
+    """
+    k = V.shape[-1]
+    eps = np.finfo(V.dtype).eps
+    I = xp.eye(k, dtype=V.dtype)
+    A = V
+    U = xp.broadcast_to(I, V.shape)
+    rounds = []
+    for pairs in _round_robin(k):
+        P, Q = np.array(pairs).T
+        E_diag = np.zeros((len(pairs), k, k)); E_diag[np.arange(len(pairs)), P, P] = 1; E_diag[np.arange(len(pairs)), Q, Q] = 1
+        E_off = np.zeros((len(pairs), k, k)); E_off[np.arange(len(pairs)), P, Q] = 1; E_off[np.arange(len(pairs)), Q, P] = -1
+        rounds.append((P, Q, E_diag, E_off))
+    for _ in range(sweeps):
+        for P, Q, E_diag, E_off in rounds:
+            app, aqq, apq = A[..., P, P], A[..., Q, Q], A[..., P, Q]  # (..., pairs)
+            # tan of the rotation angle, t = 2 apq sign(d) / (|d| + sqrt(d^2 + 4 apq^2)),
+            # written without dividing by apq. Pairs whose off-diagonal entry is
+            # below rounding relative to the diagonal are skipped, and the double
+            # where keeps their derivative finite.
+            d = aqq - app
+            rotate = xp.abs(apq) > eps * (xp.abs(app) + xp.abs(aqq))
+            r2 = xp.where(rotate, d ** 2 + 4 * apq ** 2, 1.)
+            sign = xp.where(d >= 0, 1., -1.)
+            t = xp.where(rotate, 2 * apq * sign / (xp.abs(d) + xp.sqrt(r2)), 0.)
+            c = 1 / xp.sqrt(t ** 2 + 1)
+            s = t * c
+            J = I + xp.einsum('...m,mij->...ij', c - 1, E_diag) + xp.einsum('...m,mij->...ij', s, E_off)
+            A = xp.swapaxes(J, -1, -2) @ A @ J
+            U = U @ J
+    return xp.diagonal(A, axis1=-2, axis2=-1), U
+
+
+def newton_schulz_sqrt(V, n_iter=20, xp=np):
+    """
+    Batched coupled Newton-Schulz iteration (the inverse-free form of the
+    Denman-Beavers iteration) for the square root of PSD matrices, using
+    matmuls only. V is scaled by its Frobenius norm so that the iteration
+    converges. Eigenvalues a of the scaled matrix converge after about
+    log_1.5(1/sqrt(a)) steps, so eigenvalues far below the largest one are
+    only partially resolved for small n_iter, and zero eigenvalues stay zero.
+    For singular V (e.g. xx^T with more vectors than dimensions) the rounding
+    errors in the null space of Y and Z both grow like 1.5^k, and the
+    iteration blows up once their product reaches 3, so n_iter is capped at
+    log_2.25(1/machine eps) steps (19 in float32, 44 in float64).
+    V: tensor of size [..., k, k], xp: np or jnp
+    """
+    n_iter = min(n_iter, int(np.log(1 / np.finfo(V.dtype).eps) / np.log(2.25)))
+    k = V.shape[-1]
+    I = xp.eye(k, dtype=V.dtype)
+    norm = xp.sqrt(xp.sum(V * V, axis=(-2, -1), keepdims=True))
+    norm = xp.where(norm > 0, norm, 1.)
+    Y = V / norm
+    Z = xp.broadcast_to(I, V.shape)
+    for _ in range(n_iter):
+        T = 0.5 * (3 * I - Z @ Y)
+        Y, Z = Y @ T, T @ Z
+    return Y * xp.sqrt(norm)
+
+
+def _check_backend(backend):
+    if backend not in SQRT_BACKENDS:
+        raise ValueError(f"Unknown sqrt backend {backend}, expected one of {SQRT_BACKENDS}")
+
+
+def sqrt_psd(V, eps=1e-5, backend='eigh', n_iter=None):
+    """
+    Batched square root of symmetric PSD matrices.
+    V: numpy tensor of size [..., k, k]
+    eps: eigenvalues not larger than eps are set to zero
+        (not applied by the 'newton_schulz' backend)
+    backend: 'eigh' (LAPACK), 'jacobi' or 'newton_schulz'
+    n_iter: sweeps for 'jacobi' (default 6), iterations for 'newton_schulz'
+        (default 20, capped as described in newton_schulz_sqrt)
+    """
+    _check_backend(backend)
+    if backend == 'newton_schulz':
+        return newton_schulz_sqrt(V, n_iter=n_iter or 20, xp=np)
+    if backend == 'jacobi':
+        evals, evecs = jacobi_eigh(V, sweeps=n_iter or 6, xp=np)
+    else:
+        evals, evecs = np.linalg.eigh(V)  # one stacked eigh over the whole batch
+    sqrt_evals = np.sqrt(np.where(evals > eps, evals, 0))  # (..., k)
+    return (evecs * sqrt_evals[..., None, :]) @ np.swapaxes(evecs, -1, -2)  # U sqrt(Λ) U^T
+
+
+def sqrt_psd_jax(V: jnp.ndarray, eps=1e-5, backend='eigh', n_iter=None):
+    """
+    Same as sqrt_psd, written with jax.numpy only so that it can be
+    traced by jit/vmap/grad.
+    V: jax tensor of size [..., k, k]
+    """
+    _check_backend(backend)
+    if backend == 'newton_schulz':
+        return newton_schulz_sqrt(V, n_iter=n_iter or 20, xp=jnp)
+    if backend == 'jacobi':
+        evals, evecs = jacobi_eigh(V, sweeps=n_iter or 6, xp=jnp)
+    else:
+        evals, evecs = jnp.linalg.eigh(V)
+    keep = evals > eps
+    # double where so that the clamped eigenvalues get a zero (not NaN) gradient
+    sqrt_evals = jnp.where(keep, jnp.sqrt(jnp.where(keep, evals, 1.)), 0.)  # (..., k)
+    return (evecs * sqrt_evals[..., None, :]) @ jnp.swapaxes(evecs, -1, -2)
+
+
+def _pick_method(method, n, d):
+    if method == 'auto':
+        return 'dual' if d < n else 'gram'
+    if method not in ('gram', 'dual', 'svd'):
+        raise ValueError(f"Unknown sqrt method {method}, expected 'gram', 'dual', 'svd' or 'auto'")
+    return method
+
+
+def sqrt_gram(x, method='gram', eps=1e-5, backend='eigh'):
+    """
+    Batched sqrt(x x^T) computed directly from x.
+    x: numpy tensor of size [..., n, d]
+    method: 'gram' decomposes the n x n Gram matrix x x^T,
+            'dual' decomposes the d x d matrix x^T x and maps back with
+            sqrt(x x^T) = x (x^T x)^{-1/2} x^T,
+            'svd' uses the thin SVD x = U S V^T and returns U S U^T,
+            'auto' uses 'dual' whenever d < n.
+    The rank of x x^T is at most min(n, d), so 'dual' and 'svd' cost
+    O(min(n, d)^3) instead of O(n^3) for the decomposition.
+    eps: eigenvalues of x x^T not larger than eps are set to zero
+    backend: solver for the 'gram' method, see sqrt_psd
+    """
+    n, d = x.shape[-2:]
+    method = _pick_method(method, n, d)
+    xT = np.swapaxes(x, -1, -2)
+    if method == 'gram':
+        return sqrt_psd(x @ xT, eps=eps, backend=backend)
+    if method == 'svd':
+        U, S, _ = np.linalg.svd(x, full_matrices=False)  # U (..., n, min(n,d))
+        S = np.where(S ** 2 > eps, S, 0)
+        return (U * S[..., None, :]) @ np.swapaxes(U, -1, -2)
+    evals, evecs = np.linalg.eigh(xT @ x)  # (..., d), (..., d, d)
+    keep = evals > eps
+    inv_sqrt_evals = np.where(keep, 1 / np.sqrt(np.where(keep, evals, 1)), 0)
+    P = (evecs * inv_sqrt_evals[..., None, :]) @ np.swapaxes(evecs, -1, -2)  # (x^T x)^{-1/2}
+    return x @ P @ xT
+
+
+def sqrt_gram_jax(x: jnp.ndarray, method='gram', eps=1e-5, backend='eigh'):
+    """
+    Same as sqrt_gram, written with jax.numpy only.
+    x: jax tensor of size [..., n, d]
+    """
+    n, d = x.shape[-2:]
+    method = _pick_method(method, n, d)
+    xT = jnp.swapaxes(x, -1, -2)
+    if method == 'gram':
+        return sqrt_psd_jax(x @ xT, eps=eps, backend=backend)
+    if method == 'svd':
+        U, S, _ = jnp.linalg.svd(x, full_matrices=False)
+        S = jnp.where(S ** 2 > eps, S, 0.)
+        return (U * S[..., None, :]) @ jnp.swapaxes(U, -1, -2)
+    evals, evecs = jnp.linalg.eigh(xT @ x)
+    keep = evals > eps
+    inv_sqrt_evals = jnp.where(keep, 1 / jnp.sqrt(jnp.where(keep, evals, 1.)), 0.)
+    P = (evecs * inv_sqrt_evals[..., None, :]) @ jnp.swapaxes(evecs, -1, -2)
+    return x @ P @ xT
+
+
+@jax.custom_jvp
+def eigh_safe(V: jnp.ndarray):
+    """
+    jnp.linalg.eigh with a derivative that stays finite for (nearly)
+    degenerate eigenvalues: the eigenvector derivative drops the terms
+    1/(λ_j - λ_i) whose gap is below 1e-9 instead of dividing by it.
+    V: jax tensor of size [..., k, k]
+    """
+    evals, evecs = jnp.linalg.eigh(V)
+    return evals, evecs  # a plain tuple, the structure of the jvp rule output
+
+
+@eigh_safe.defjvp
+def _eigh_safe_jvp(primals, tangents):
+    V, = primals
+    dV, = tangents
+    evals, evecs = eigh_safe(V)
+    dVt = jnp.swapaxes(evecs, -1, -2) @ dV @ evecs  # (..., k, k)
+    gap = evals[..., None, :] - evals[..., :, None]  # λ_j - λ_i
+    ok = jnp.abs(gap) > 1e-9
+    F = jnp.where(ok, 1 / jnp.where(ok, gap, 1.), 0.)
+    devals = jnp.diagonal(dVt, axis1=-2, axis2=-1)
+    devecs = evecs @ (F * dVt)
+    return (evals, evecs), (devals, devecs)
+
+
+def sqrt_psd_frechet(evals, evecs, dV, eps=1e-5):
+    """
+    Directional derivative of sqrt_psd_jax at V = U diag(evals) U^T along dV
+    (Daleckii-Krein formula). The divided differences of sqrt are written as
+    1/(s_i + s_j), which is exact for equal eigenvalues, and pairs whose
+    eigenvalues are both clamped to zero get a zero derivative.
+    evals: [..., k], evecs: [..., k, k], dV: [..., k, k]
+    """
+    keep = evals > eps
+    s = jnp.where(keep, jnp.sqrt(jnp.where(keep, evals, 1.)), 0.)
+    denom = s[..., :, None] + s[..., None, :]
+    pos = denom > 0
+    K = jnp.where(pos, 1 / jnp.where(pos, denom, 1.), 0.)
+    evecsT = jnp.swapaxes(evecs, -1, -2)
+    return evecs @ (K * (evecsT @ dV @ evecs)) @ evecsT